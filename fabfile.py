@@ -78,8 +78,9 @@ def deploy():
         sudo('chown -R www-data:www-data %s' % newdir)
     #Pythonnginx
     with settings(warn_only=True):
-        sudo('supervisorctl stop awesome')
-        sudo('supervisorctl start awesome')
+        # app.py masterյHUPƽworkerڴ
+        # masterԼĴ(workers.py)иĶʱҪsupervisorctl restart awesome
+        sudo('supervisorctl signal HUP awesome')
         sudo('/etc/init.d/nginx reload')
 
 RE_FILES = re.compile('\r?\n')
@@ -126,8 +127,7 @@ def rollback():
         sudo('ln -s %s www' % old)
         sudo('chown www-data:www-data www')
         with settings(warn_only=True):
-            sudo('supervisorctl stop awesome')
-            sudo('supervisorctl start awesome')
+            sudo('supervisorctl signal HUP awesome')
             sudo('/etc/init.d/nginx reload')
         print ('ROLLBACKED OK.')
 
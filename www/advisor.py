@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__='Wby'
+
+'''
+Index advisor: compares the where/orderBy shapes recorded by orm with SHOW INDEX.
+'''
+
+import re,asyncio
+
+import orm
+
+#`col`=?、col<?、col in (...)等，取出列名和比较符
+_RE_CONDITION=re.compile(r'`?([A-Za-z_]\w*)`?\s*(<=|>=|<>|!=|=|<|>|\bin\b|\blike\b|\bbetween\b|\bis\b)',re.I)
+
+#where里用到的列，返回(等值比较的列,范围比较的列)，都按出现的顺序
+#同一列既有等值又有范围比较的(如游标分页的条件)算作范围比较
+def parse_where(where):
+    eq=[]
+    rng=[]
+    for col,op in _RE_CONDITION.findall(where or ''):
+        col=col.lower()
+        target=eq if op.lower() in ('=','in','is') else rng
+        if col not in target:
+            target.append(col)
+    return [c for c in eq if c not in rng],rng
+
+#order by用到的列
+def parse_order(orderBy):
+    cols=[]
+    for part in (orderBy or '').split(','):
+        words=part.replace('`','').split()
+        if words:
+            cols.append(words[0].lower())
+    return cols
+
+#读取表的索引，{索引名:[列名,...]}，列按在索引里的顺序
+@asyncio.coroutine
+def load_indexes(table):
+    rs=yield from orm.select('show index from `%s`'%table,[])
+    indexes={}
+    for r in sorted(rs,key=lambda r:(r['Key_name'],r['Seq_in_index'])):
+        indexes.setdefault(r['Key_name'],[]).append(r['Column_name'].lower())
+    return indexes
+
+#检查一种查询形状能不能用上索引，返回(能用上的索引名,问题)
+#问题为None表示没问题，'full scan'表示where没有可用的索引，'filesort'表示where能用索引但排序不能
+#按最左前缀匹配：索引的前几列要覆盖所有等值比较的列，接下来的一列是第一个范围比较的列或第一个排序列
+def check_shape(eq,rng,order,indexes):
+    if not eq and not rng and not order:
+        return None,None
+    best=None
+    for name,cols in indexes.items():
+        n=0
+        while n<len(cols) and cols[n] in eq:
+            n+=1
+        if set(cols[:n])!=set(eq):
+            continue
+        rest=cols[n:]
+        follows=bool(rest) and (rest[0] in rng[:1] or (bool(order) and rest[0]==order[0]))
+        if follows or not (rng or order):
+            return name,None
+        if eq and best is None:
+            best=name
+    if best is not None:
+        return best,'filesort'
+    return None,'full scan'
+
+#建议的索引：等值比较的列，再加上第一个范围比较的列或排序列
+def suggest(table,eq,rng,order):
+    cols=list(eq)
+    for c in (rng[:1] or order):
+        if c not in cols:
+            cols.append(c)
+    return 'alter table `%s` add key `idx_%s` (%s);'%(table,'_'.join(cols),','.join('`%s`'%c for c in cols))
+
+#检查运行以来记录的所有查询形状，返回[{table,where,order_by,count,index,problem,suggestion},...]
+@asyncio.coroutine
+def advise():
+    indexes={}
+    result=[]
+    for shape in orm.query_shapes():
+        table=shape['table']
+        if table not in indexes:
+            indexes[table]=yield from load_indexes(table)
+        eq,rng=parse_where(shape['where'])
+        order=parse_order(shape['order_by'])
+        index,problem=check_shape(eq,rng,order,indexes[table])
+        shape.update(index=index,problem=problem,suggestion=suggest(table,eq,rng,order) if problem else None)
+        result.append(shape)
+    return result
@@ -3,6 +3,8 @@
 
 import json,logging,inspect,functools
 
+from orm import encode_cursor
+
 #简单的几个api错误异常类，用于抛出异常
 class APIError(Exception):
     """APIError"""
@@ -59,11 +61,48 @@ class Page(object):
         #这页之前是否有上一页
         self.has_previous=self.page_index>1
 
+    #json编码时用的字段，和__dict__的内容一样
+    def __json__(self):
+        return dict(item_count=self.item_count,page_size=self.page_size,page_count=self.page_count,page_index=self.page_index,offset=self.offset,limit=self.limit,has_next=self.has_next,has_previous=self.has_previous)
+
     def __str__(self):
         return 'item_count:%s,page_count:%s,page_index:%s,page_size:%s,offset:%s,limit:%s'%(self.item_count,self.page_count,self.page_index,self.page_size,self.offset,self.limit)
 
     __repr__=__str__
 
+#游标分页的页面属性，翻页不需要知道总条数，也不支持跳页
+class CursorPage(object):
+    """docstring for CursorPage"""
+    #参数说明
+    #cursor:上一页返回的next_cursor，为空表示第一页
+    #page_size:每页的条目数量
+    def __init__(self, cursor=None,page_size=4):
+        super(CursorPage, self).__init__()
+        self.cursor=cursor or None
+        self.page_size=page_size
+        #多取一条，用来判断后面还有没有下一页
+        self.limit=page_size+1
+        self.next_cursor=None
+        self.has_next=False
+        self.has_previous=self.cursor is not None
+
+    #传入按limit查出来的条目，去掉多取的那一条，并算出下一页的cursor
+    def apply(self,items):
+        if len(items)>self.page_size:
+            items=items[:self.page_size]
+            self.has_next=True
+            last=items[-1]
+            self.next_cursor=encode_cursor(last.created_at,last.getValue(last.__primary_key__))
+        return items
+
+    def __json__(self):
+        return dict(cursor=self.cursor,page_size=self.page_size,limit=self.limit,next_cursor=self.next_cursor,has_next=self.has_next,has_previous=self.has_previous)
+
+    def __str__(self):
+        return 'cursor:%s,page_size:%s,next_cursor:%s'%(self.cursor,self.page_size,self.next_cursor)
+
+    __repr__=__str__
+
 
        
 
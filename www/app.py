@@ -8,21 +8,58 @@ async web application.
 '''
 
 import logging; logging.basicConfig(level=logging.INFO)
-import asyncio, os, json, time
+import asyncio, os, sys, stat, json, time, signal, socket, argparse
 from datetime import datetime
 
 from aiohttp import web
-from jinja2 import Environment,FileSystemLoader
+from jinja2 import Environment,FileSystemLoader,FileSystemBytecodeCache
 
 from config import configs
-import orm
+import orm,metrics,jsonenc
 
-from coroweb import add_routes,add_static
+from coroweb import get,add_route,add_routes,add_static,conditional_response
+from cache import LRUCache
+from fragments import FragmentCache
 
 from handlers import cookie2user,COOKIE_NAME
+import workers
 
+#带命中统计的模板字节码缓存，编译好的模板保存在磁盘上，其他worker和重启之后可以直接加载
+#模板源码改了的话jinja2会校验出来重新编译
+class CountingBytecodeCache(FileSystemBytecodeCache):
+    """docstring for CountingBytecodeCache"""
+    def __init__(self, directory):
+        super(CountingBytecodeCache, self).__init__(directory)
+        self.hits=0
+        self.misses=0
+
+    def load_bytecode(self,bucket):
+        super(CountingBytecodeCache, self).load_bytecode(bucket)
+        if bucket.code is None:
+            self.misses+=1
+        else:
+            self.hits+=1
+
+#jinja2会直接执行字节码缓存目录里的代码，别的用户能写这个目录的话就能以web进程的身份执行任意代码
+#目录不存在时创建为0700，已存在的目录必须属于当前用户并且组和其他用户不可写
+def check_bytecode_cache_dir(directory):
+    os.makedirs(directory,mode=0o700,exist_ok=True)
+    st=os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid!=os.getuid() or st.st_mode&(stat.S_IWGRP|stat.S_IWOTH):
+        raise RuntimeError('unsafe jinja2 bytecode cache directory %s: it must be a directory owned by uid %s and not writable by group or others'%(directory,os.getuid()))
+
+#加载(编译)所有模板，返回模板数量
+def precompile_templates(env):
+    names=env.list_templates(filter_func=lambda n:n.endswith('.html'))
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+#production为True时是生产模式：不检查模板文件是否修改，编译结果保存到bytecode_cache目录
+#启动时由warm_up编译好所有模板
 def init_jinja2(app,**kw):
     logging.info('init jinja2...')
+    production=kw.get('production',False)
     #初始化模板配置，包括模板运行代码的开始结束标识符，变量的开始结束标识符等
     options=dict(
             autoescape=kw.get('autoescape',True),#是否转义设置为True,就是在渲染模板时自动把变量的<>&等字符转换为&lt;&gt;&amp
@@ -31,8 +68,17 @@ def init_jinja2(app,**kw):
             variable_start_string=kw.get('variable_start_string','{{'),  #变量开始标识符
             variable_end_string=kw.get('variable_end_string','}}'),      #变量结束标识符
             #Jinja2会在使用Template时检查模板文件的状态，如果模板有修改，则重新加载模板。如果对性能要求高，可以设置为False
-            auto_reload=kw.get('auto_reload',True) 
+            auto_reload=kw.get('auto_reload',not production),
+            #{% cache key,ttl %}...{% endcache %}模板片段缓存
+            extensions=kw.get('extensions',['fragments.FragmentCacheExtension'])
         )
+    bcc=None
+    if production:
+        directory=kw.get('bytecode_cache')
+        if directory:
+            check_bytecode_cache_dir(directory)
+        bcc=CountingBytecodeCache(directory)
+        options['bytecode_cache']=bcc
     #从参数中获取path字段，即模板文件的位置
     path=kw.get('path',None)
     #如果没有，则默认为当前文件目录下的templates目录
@@ -48,10 +94,39 @@ def init_jinja2(app,**kw):
     if filters is not None:
         for name,f in filters.items():
             env.filters[name]=f
+    if hasattr(env,'fragment_cache'):
+        env.fragment_cache=FragmentCache(kw.get('fragment_cache_size',1000),kw.get('fragment_cache_ttl',300))
+        metrics.register_collector(metrics.cache_collector('fragment',env.fragment_cache))
 
     #给webapp设置模板
     app['__templating__']=env
 
+#请求数、耗时和正在处理的请求数，放在最外层，统计的是整个中间件链的耗时
+@asyncio.coroutine
+def metrics_factory(app,handler):
+    @asyncio.coroutine
+    def collect(request):
+        start=time.time()
+        metrics.request_started()
+        status=500
+        try:
+            r=yield from handler(request)
+            status=r.status
+            return r
+        except web.HTTPException as e:
+            status=e.status
+            raise
+        finally:
+            #用注册的路径作为route，静态文件和没有匹配的url各算一类
+            route=getattr(request.match_info.handler,'route',None) or ('/static/' if request.path.startswith('/static/') else 'other')
+            metrics.request_finished(request.method,route,status,time.time()-start)
+    return collect
+
+#prometheus格式的指标
+@get('/metrics')
+def metrics_handler():
+    return web.Response(body=metrics.render().encode('utf-8'),headers={'Content-Type':'text/plain; version=0.0.4; charset=utf-8'})
+
 #在正式处理之前打印日志
 @asyncio.coroutine
 def logger_factory(app,handler):
@@ -75,6 +150,49 @@ def data_factory(app,handler):
         return (yield from handler(request))
     return parse_data
 
+#匿名用户GET请求的整页缓存，只缓存@get(path,cache_ttl=...)声明了有效时间的路由
+#key是path和query string，值是(Content-Type,body,ETag)
+#写博客、评论的handler会调用handlers.invalidate_pages删除相关页面
+#invalidate_pages只能删除当前进程的缓存，所以多worker时有效时间不超过response_cache.shared_ttl
+@asyncio.coroutine
+def cache_factory(app,handler):
+    @asyncio.coroutine
+    def cache(request):
+        #登录用户的页面里有用户信息，不缓存
+        if request.method!='GET' or request.cookies.get(COOKIE_NAME):
+            return (yield from handler(request))
+        ttl=getattr(request.match_info.handler,'cache_ttl',None)
+        if not ttl:
+            return (yield from handler(request))
+        if app['__response_cache_max_ttl__'] is not None:
+            ttl=min(ttl,app['__response_cache_max_ttl__'])
+        key=request.path_qs
+        cached=app['__response_cache__'].get(key)
+        if cached is not None:
+            content_type,body,etag=cached
+            return conditional_response(request,body,content_type,etag)
+        r=yield from handler(request)
+        if type(r) is web.Response and r.status==200 and r.body:
+            app['__response_cache__'].set(key,(r.headers.get('Content-Type'),r.body,r.headers.get('ETag')),ttl)
+        return r
+    return cache
+
+#每个请求一个IdentityMap，同一个请求里按主键加载同一个对象只查一次数据库，请求结束时丢弃
+#要放在auth_factory前面，cookie2user加载的用户也会放进去
+@asyncio.coroutine
+def identity_map_factory(app,handler):
+    @asyncio.coroutine
+    def identity_map(request):
+        imap=orm.IdentityMap(configs.db.identity_map_debug)
+        token=orm.identity_map.set(imap)
+        try:
+            return (yield from handler(request))
+        finally:
+            orm.identity_map.reset(token)
+            if imap.debug and imap.hits:
+                logging.info('identity map:%s %s avoided %s queries'%(request.method,request.path,imap.hits))
+    return identity_map
+
 #是为了验证当前的这个请求用户是否在登录状态下，或是否是伪造的shal
 @asyncio.coroutine
 def auth_factory(app,handler):
@@ -97,6 +215,20 @@ def auth_factory(app,handler):
         return(yield from handler(request))
     return auth
 
+#分块输出json，每编码一块就写出去，不用先生成整个响应体
+@asyncio.coroutine
+def stream_json(request,r):
+    resp=web.StreamResponse()
+    resp.content_type='application/json'
+    resp.charset='utf-8'
+    resp.enable_chunked_encoding()
+    yield from resp.prepare(request)
+    for chunk in jsonenc.iterdumps(r,configs.json.chunk_size):
+        resp.write(chunk)
+        yield from resp.drain()
+    yield from resp.write_eof()
+    return resp
+
 #相应处理
 #总结，来一个请求在服务端收到后的方法调用顺序是：
 #   logger_factory->response_factory->RequestHandler().__call__->get或post->handler
@@ -136,17 +268,28 @@ def response_factory(app,handler):
             #先查看一下有没有'__template__'为key的值
             template=r.get('__template__')
             #如果没有，说明要返回json字符串，则把字典转换为json返回，对应的response类型设为json类型
+            #GET请求的json和模板响应都带上ETag，客户端缓存没过期的话返回304
+            #handler调用过coroweb.not_modified/set_version的话，用它的版本号作为ETag，否则根据body生成
+            #不发Last-Modified：列表里的记录被删除或修改后，max(created_at)不会变，只带If-Modified-Since的客户端会拿到错误的304
+            etag=getattr(request,'__etag__',None)
             if template is None:
-                resp=web.Response(body=json.dumps(r,ensure_ascii=False,default=lambda o:o.__dict__).encode('utf-8'))
-                resp.content_type='application/json;charset=utf-8'
-                return resp
+                #很大的列表分块编码输出，这样的响应不算ETag，也不进整页缓存
+                if jsonenc.has_large_list(r,configs.json.stream_threshold):
+                    return (yield from stream_json(request,r))
+                body=jsonenc.dumps(r)
+                content_type='application/json;charset=utf-8'
             else:
                 r['__user__']=request.__user__
                 #如果有'__template__'为key的值，则说明要套用jinja2的模板，‘__template__’key对应的模板网页所在位置
-                resp=web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-                resp.content_type='text/html;charset=utf-8'
-                #以html的形式返回
+                start=time.time()
+                body=app['__templating__'].get_template(template).render(**r).encode('utf-8')
+                metrics.observe_template(template,time.time()-start)
+                content_type='text/html;charset=utf-8'
+            if request.method!='GET':
+                resp=web.Response(body=body)
+                resp.content_type=content_type
                 return resp
+            return conditional_response(request,body,content_type,etag)
         #如果响应结果为int
         if isinstance(r,int) and r>=100 and r<600:
             return web.Response(r)
@@ -176,8 +319,11 @@ def datetime_filter(t):
     dt=datetime.fromtimestamp(t)
     return u'%s年%s月%s日'%(dt.year,dt.month,dt.day)
 
+#sock:master传过来的监听socket，为None时自己监听配置里的host和port
+#workers:worker进程数，多于1个时整页缓存的有效时间不超过response_cache.shared_ttl
+#返回(app,handler,srv)，退出时用来关闭服务
 @asyncio.coroutine
-def init(loop):
+def init(loop,sock=None,workers=0):
     #创建数据库连接池，db参数传递配置文件里面配置的db
     #yield from print(configs.db)
     yield from orm.create_pool(loop=loop,**configs.db)
@@ -186,24 +332,102 @@ def init(loop):
     #譬如这里logger_factory的handler参数其实就是response_factory()
     #middlewares的最后一个元素的Handler会通过routes查找到对应的，其实就是routes注册的对应的handler
     app=web.Application(loop=loop,middlewares=[
-            logger_factory,auth_factory,response_factory
+            metrics_factory,logger_factory,cache_factory,identity_map_factory,auth_factory,response_factory
         ])
+    #整页缓存，大小按body的字节数计算
+    app['__response_cache__']=LRUCache(configs.response_cache.maxsize,maxbytes=configs.response_cache.maxbytes,sizeof=lambda k,v:len(k)+len(v[1]))
+    app['__response_cache_max_ttl__']=configs.response_cache.shared_ttl if workers>1 else None
+    metrics.register_collector(metrics.cache_collector('response',app['__response_cache__']))
+    logging.info('json encoder:%s'%jsonenc.use(configs.json.encoder))
     #初始化jinja2模板
-    init_jinja2(app,filters=dict(datetime=datetime_filter))
+    init_jinja2(app,filters=dict(datetime=datetime_filter),production=configs.templates.production,bytecode_cache=configs.templates.bytecode_cache,fragment_cache_size=configs.templates.fragment_cache_size,fragment_cache_ttl=configs.templates.fragment_cache_ttl)
     #添加请求的handlers，即各请求对应的处理函数
     add_routes(app,'handlers')
+    add_route(app,metrics_handler)
     #添加静态文件所在地址
     add_static(app)
+    #先预热再监听，接到的第一个请求不用等模板编译和建立数据库连接
+    yield from warm_up(app)
     #启动
-    srv=yield from loop.create_server(app.make_handler(),'127.0.0.1',9000)
-    logging.info('server started at http://127.0.0.1:9000...')
-    return srv
+    handler=app.make_handler()
+    if sock is None:
+        srv=yield from loop.create_server(handler,configs.server.host,configs.server.port)
+        logging.info('server started at http://%s:%s...'%(configs.server.host,configs.server.port))
+    else:
+        srv=yield from loop.create_server(handler,sock=sock)
+        logging.info('worker %s started at http://%s:%s...'%(os.getpid(),*sock.getsockname()[:2]))
+    return app,handler,srv
 
-#入口，固定写法，获取EventLoop，然后加入运行事件
-loop = asyncio.get_event_loop()
-#执行
-loop.run_until_complete(init(loop))
-loop.run_forever()
+#停止服务：不再接受新连接，等正在处理的请求完成(最多timeout秒)，关闭连接池
+@asyncio.coroutine
+def shutdown(app,handler,srv,timeout=60.0):
+    srv.close()
+    yield from srv.wait_closed()
+    yield from app.shutdown()
+    yield from handler.shutdown(timeout)
+    yield from app.cleanup()
+    yield from orm.close_pool()
+
+#预热：编译所有模板，连接池里先建好连接，这样新worker接到的第一个请求也不会慢
+#init在create_server之前调用，平滑重启时预热完成之前新worker不会从共享的socket上接连接
+@asyncio.coroutine
+def warm_up(app):
+    env=app['__templating__']
+    bcc=env.bytecode_cache
+    start=time.time()
+    n=precompile_templates(env)
+    logging.info('precompiled %s templates in %.3fs, bytecode cache hits:%s misses:%s'%(n,time.time()-start,bcc.hits if bcc else 0,bcc.misses if bcc else 0))
+    yield from orm.select('select 1',[])
+
+#运行一个服务进程，收到SIGTERM或SIGINT时优雅退出
+#由master启动的worker在master退出后也会自己退出
+#ready_fd:平滑重启时master传入的管道，预热完成并开始监听后写一个字节通知master
+#退出时handler.shutdown会关掉空闲的keep-alive连接，正在处理的请求处理完后再关闭
+def run_worker(sock=None,ready_fd=None,workers=0):
+    loop=asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app,handler,srv=loop.run_until_complete(init(loop,sock,workers))
+    if ready_fd is not None:
+        os.write(ready_fd,b'1')
+        os.close(ready_fd)
+    for signum in (signal.SIGTERM,signal.SIGINT):
+        loop.add_signal_handler(signum,loop.stop)
+    if sock is not None:
+        ppid=os.getppid()
+        def check_master():
+            if os.getppid()!=ppid:
+                logging.warning('master %s is gone, worker %s exiting'%(ppid,os.getpid()))
+                loop.stop()
+            else:
+                loop.call_later(1.0,check_master)
+        loop.call_later(1.0,check_master)
+    loop.run_forever()
+    logging.info('worker %s shutting down...'%os.getpid())
+    loop.run_until_complete(shutdown(app,handler,srv))
+    loop.close()
+
+def parse_args():
+    parser=argparse.ArgumentParser(description='Awesome Python Webapp')
+    parser.add_argument('--workers',type=int,default=configs.server.workers,help='number of worker processes, 0 runs the app in this process')
+    #master启动worker时传入继承的监听socket的fd
+    parser.add_argument('--fd',type=int,default=None,help=argparse.SUPPRESS)
+    #平滑重启时master传入的管道fd，worker就绪后往里面写一个字节
+    parser.add_argument('--ready-fd',type=int,default=None,help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+#入口
+if __name__=='__main__':
+    args=parse_args()
+    if args.fd is not None:
+        #master启动的worker
+        run_worker(socket.socket(fileno=args.fd),args.ready_fd,args.workers)
+    elif args.workers>0:
+        #多进程模式：master监听端口，启动workers个worker共享这个socket
+        sock=workers.create_listen_socket(configs.server.host,configs.server.port)
+        logging.info('server listening at http://%s:%s...'%(configs.server.host,configs.server.port))
+        workers.Master(sock,args.workers,os.path.abspath(sys.argv[0])).run()
+    else:
+        run_worker()
 
 
 #原有简单写法
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Microbenchmark of RequestHandler dispatch overhead.
+
+Compares the precompiled binder in coroweb.RequestHandler with the previous
+implementation that re-analysed the request on every call.
+
+    python3 bench/bench_dispatch.py [-n 100000]
+'''
+
+import os,sys,time,asyncio,argparse,logging
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from urllib import parse
+
+from aiohttp import web
+
+from apis import APIError
+from coroweb import RequestHandler
+
+#只测量分发的开销，不输出日志，但旧实现里的字符串格式化仍然会执行
+logging.disable(logging.INFO)
+
+#之前的实现，每个请求都重新分析参数
+class LegacyRequestHandler(RequestHandler):
+    @asyncio.coroutine
+    def __call__(self,request):
+        kw=None
+        logging.info('%s : has_request_arg=%s,has_var_kw_arg=%s,has_named_kw_args=%s,get_named_kw_args=%s,get_required_kw_args=%s'%(__name__,self._has_request_arg,self._has_var_kw_arg,self._has_named_kw_args,self._named_kw_args,self._request_kw_args))
+        #如果处理函数需要传入特定的key的参数或者可变参数的话
+        if self._has_var_kw_arg or self._has_named_kw_args or self._request_kw_args:
+            #如果是post请求，则读请求的body
+            if request.method=='POST':
+                #如果request的头中没有Content-type，则返回错误描述
+                if not request.content_type:
+                    return web.HTTPBadRequest('Missing Content_type')
+                #字符串全部转为小写
+                ct=request.content_type.lower()
+                #如果是’application/json‘类型
+                if ct.startswith('application/json'):
+                    #把request的body，按json的方式输出为一个字典
+                    params=yield from request.json()
+                    #解读出错或params不是一个字典，则返回错误
+                    if not isinstance(params,dict):
+                        return web.HTTPBadRequest('JSON Body must be object')
+                    #保存这个params
+                    kw=params
+                #如果是'application/x-www-form-urlencoded'或'multipart/form-data'，直接读出来并保存
+                elif ct.startswith('application/x-www-form-urlencoded' or ct.startswith('multipart/form-data')):
+                    params=yield from request.post()
+                    kw=dict(**params)
+                else:
+                    return web.HTTPBadRequest('Unsupported Content_type:%s'% request.content_type)
+            #如果是get请求，则读取url字符串
+            if request.method=='GET':
+                #看url有没有参数，即?后面的字符串
+                qs=request.query_string
+                logging.info('qs=%s'%qs)
+                #如果有的话，则把参数以键值的方式存起来赋值给kw
+                if qs:
+                    kw=dict()
+                    for k,v in parse.parse_qs(qs,True).items():
+                        kw[k]=v[0]
+        #如果kw为空的话，kw设置为request.match_info
+        if kw is None:
+            kw=dict(**request.match_info)
+            logging.info('kw=%s'%kw)
+        else:
+            #如果kw有值的话
+            #如果处理方法需要传入**kw，且需要传入关键字参数
+            if not self._has_var_kw_arg and self._named_kw_args:
+                copy=dict()
+                #从kw中筛选出url处理方法需要传入参数对
+                for name in self._named_kw_args:
+                    if name in kw:
+                        copy[name]=kw[name]
+                kw=copy
+            #从match_info中筛选出url处理方法需要传入的参数对
+            for k,v in request.match_info.items():
+                if k in kw:
+                    logging.warning('Duplicate arg name in named arg and kw args:%s'%k)
+                kw[k]=v
+        #如果参数需要传入'request'参数，则把request实例传入
+        if self._has_request_arg:
+            kw['request']=request
+
+        #如果参数有默认为None的关键字参数，遍历一下kw,如果kw中没有这个key,抛错
+        if self._request_kw_args:
+            for name in self._request_kw_args:
+                if not name in kw:
+                    return web.HTTPBadRequest('Missing argument:%s'%name)
+        logging.info('call with args:%s'%str(kw))
+        try:
+            #对url进行处理
+            r=yield from self._func(**kw)
+            return r
+        except APIError as e:
+            return dict(error=e.error,data=e.data,message=e.message)
+
+#模拟aiohttp的request，只实现RequestHandler用到的属性
+class FakeRequest(object):
+    def __init__(self,method='GET',query_string='',match_info=None,body=None):
+        self.method=method
+        self.query_string=query_string
+        self.match_info=match_info or {}
+        self.content_type='application/json' if body is not None else ''
+        self._body=body
+
+    @asyncio.coroutine
+    def json(self):
+        return dict(self._body)
+
+#和handlers.py里形式相同的url处理函数
+@asyncio.coroutine
+def register():
+    return {'__template__':'register.html'}
+
+@asyncio.coroutine
+def api_blogs(*,page='1',cursor=None):
+    return dict(page=page)
+
+@asyncio.coroutine
+def get_blog(id,request):
+    return dict(id=id)
+
+@asyncio.coroutine
+def api_create_comment(id,request,*,content):
+    return dict(id=id,content=content)
+
+CASES=[
+    ('GET no args',register,FakeRequest()),
+    ('GET query string',api_blogs,FakeRequest(query_string='page=2')),
+    ('GET match_info+request',get_blog,FakeRequest(match_info={'id':'0015'})),
+    ('POST json+match_info',api_create_comment,FakeRequest('POST',match_info={'id':'0015'},body={'content':'hello'})),
+]
+
+#返回每次调用的平均耗时(微秒)
+def bench(handler,request,n):
+    @asyncio.coroutine
+    def run():
+        for i in range(n):
+            yield from handler(request)
+    loop=asyncio.get_event_loop()
+    t=time.perf_counter()
+    loop.run_until_complete(run())
+    return (time.perf_counter()-t)/n*1e6
+
+def main():
+    parser=argparse.ArgumentParser(description='RequestHandler dispatch microbenchmark')
+    parser.add_argument('-n',type=int,default=100000,help='calls per case')
+    n=parser.parse_args().n
+    print('%-26s %12s %12s %8s'%('case','before(us)','after(us)','speedup'))
+    for name,fn,request in CASES:
+        before=bench(LegacyRequestHandler(None,fn),request,n)
+        after=bench(RequestHandler(None,fn),request,n)
+        print('%-26s %12.2f %12.2f %7.2fx'%(name,before,after,before/after))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Throughput of the JSON encoders on /api/blogs and /api/comments payloads.
+
+Compares the previous json.dumps(default=lambda o:o.__dict__) call in
+response_factory with every encoder jsonenc can use here, and the chunked
+iterdumps output for large lists.
+
+    python3 bench/bench_json.py [-n 2000] [--items 100]
+'''
+
+import os,sys,time,json,argparse,logging
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jsonenc
+
+from apis import Page
+from models import Blog,Comment,next_id
+
+logging.disable(logging.INFO)
+
+def legacy_dumps(r):
+    return json.dumps(r,ensure_ascii=False,default=lambda o:o.__dict__).encode('utf-8')
+
+#/api/blogs的响应，博客带正文和渲染后的html
+def blogs_payload(n):
+    blogs=[]
+    for i in range(n):
+        content='# 标题%s\n\n'%i+'这是一段博客正文, some text with "quotes" & <tags>.\n'*40
+        blogs.append(Blog(id=next_id(),user_id=next_id(),user_name='管理员',user_image='http://www.gravatar.com/avatar/x?d=mm&s=120',name='博客%s'%i,summary='摘要'*20,content=content,html_content='<p>%s</p>'%content,content_hash='0'*40,renderer_version=1,created_at=time.time()))
+    return dict(page=Page(n*10,1,n),blogs=blogs)
+
+#/api/comments的响应，很多条短评论
+def comments_payload(n):
+    comments=[Comment(id=next_id(),blog_id=next_id(),user_id=next_id(),user_name='用户%s'%i,user_image='http://www.gravatar.com/avatar/x?d=mm&s=120',content='评论内容 comment %s'%i,created_at=time.time()) for i in range(n)]
+    return dict(page=Page(n*10,1,n),comments=comments)
+
+def bench(fn,r,n):
+    size=len(fn(r))
+    start=time.perf_counter()
+    for i in range(n):
+        fn(r)
+    t=time.perf_counter()-start
+    return n/t,size*n/t/1024/1024
+
+def main():
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-n',type=int,default=2000,help='iterations per encoder')
+    parser.add_argument('--items',type=int,default=100,help='blogs/comments per payload')
+    parser.add_argument('--chunk-size',type=int,default=100,help='list items per iterdumps chunk')
+    args=parser.parse_args()
+    payloads=[('/api/blogs',blogs_payload(args.items)),('/api/comments',comments_payload(args.items*10))]
+    for path,r in payloads:
+        print('%s (%s items, %s bytes)'%(path,len(r.get('blogs',r.get('comments'))),len(legacy_dumps(r))))
+        base,mb=bench(legacy_dumps,r,args.n)
+        print('  %-20s %10.0f resp/s %8.1f MB/s  x1.00'%('legacy json.dumps',base,mb))
+        for name in jsonenc.available():
+            jsonenc.use(name)
+            for label,fn in ((name,jsonenc.dumps),(name+' iterdumps',lambda r:b''.join(jsonenc.iterdumps(r,args.chunk_size)))):
+                ops,mb=bench(fn,r,args.n)
+                print('  %-20s %10.0f resp/s %8.1f MB/s  x%.2f'%(label,ops,mb,ops/base))
+    jsonenc.use()
+
+if __name__=='__main__':
+    main()
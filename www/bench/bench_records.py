@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Memory and time of loading rows as Model objects vs compact Record objects.
+
+The rows are generated in memory, so only the ORM side is measured: the
+DictCursor dict that aiomysql builds for every row plus cls(**row) for Model,
+against Record(*row) built directly from a tuple cursor row.
+
+    python3 bench/bench_records.py [-n 100000]
+'''
+
+import os,sys,time,gc,argparse,logging,tracemalloc
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logging.disable(logging.INFO)
+
+from models import Blog,Comment,next_id
+
+#按__select__的列顺序生成tuple行，和aiomysql.Cursor返回的一样
+def make_rows(model,n):
+    rows=[]
+    for i in range(n):
+        row=[]
+        for name in [model.__primary_key__]+model.__fields__:
+            if name=='created_at':
+                row.append(time.time()+i)
+            elif name=='renderer_version':
+                row.append(1)
+            elif name in ('content','html_content'):
+                row.append('内容 content %s '%i*8)
+            else:
+                row.append('%s-%s'%(name,next_id()))
+        rows.append(tuple(row))
+    return rows
+
+#aiomysql.DictCursor把每一行转成dict，findAll再用它构造Model
+def load_models(model,names,rows):
+    return [model(**dict(zip(names,r))) for r in rows]
+
+def load_records(model,names,rows):
+    record=model.__record__
+    return [record(*r) for r in rows]
+
+def measure(fn,*args):
+    gc.collect()
+    tracemalloc.start()
+    start=time.perf_counter()
+    objs=fn(*args)
+    t=time.perf_counter()-start
+    size,peak=tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    #访问一遍属性
+    start=time.perf_counter()
+    for o in objs:
+        o.created_at
+        o.user_name
+    access=time.perf_counter()-start
+    return t,access,size
+
+def main():
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-n',type=int,default=100000,help='rows per load')
+    args=parser.parse_args()
+    for model in (Blog,Comment):
+        names=[model.__primary_key__]+model.__fields__
+        rows=make_rows(model,args.n)
+        print('%s x %s rows'%(model.__name__,args.n))
+        base=None
+        for label,fn in (('Model (DictCursor)',load_models),('Record (tuple)',load_records)):
+            t,access,size=measure(fn,model,names,rows)
+            base=base or (t,size)
+            print('  %-20s load %.3fs (x%.2f)  attribute access %.3fs  retained %.1f MB (x%.2f)'%(label,t,base[0]/t,access,size/1024/1024,base[1]/size))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__='Wby'
+
+'''
+In-process caches.
+'''
+
+import time
+
+from collections import OrderedDict
+
+#带过期时间和容量上限的LRU缓存
+#maxsize:最多保存的条目数
+#ttl:默认的有效时间(秒)，None表示不过期
+#maxbytes:所有条目的总大小上限，None表示不限制，条目大小由sizeof(key,value)计算
+class LRUCache(object):
+    """LRU cache with TTL and hit/miss counters"""
+    def __init__(self, maxsize=1024,ttl=None,maxbytes=None,sizeof=None):
+        self.maxsize=maxsize
+        self.ttl=ttl
+        self.maxbytes=maxbytes
+        self.sizeof=sizeof
+        #key->(value,expires,size)，OrderedDict的顺序就是最近使用的顺序，最旧的在最前面
+        self._data=OrderedDict()
+        self.bytes=0
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self,key):
+        return self.get(key,_MISSING,count=False) is not _MISSING
+
+    #取值，过期的条目会被删除并算作一次未命中
+    def get(self,key,default=None,count=True):
+        item=self._data.get(key)
+        if item is not None:
+            value,expires,size=item
+            if expires is None or expires>time.time():
+                self._data.move_to_end(key)
+                if count:
+                    self.hits+=1
+                return value
+            self._delete(key)
+        if count:
+            self.misses+=1
+        return default
+
+    #存值，ttl为None时使用默认ttl；ttl<=0的条目不保存
+    def set(self,key,value,ttl=None):
+        if ttl is None:
+            ttl=self.ttl
+        self._delete(key)
+        if ttl is not None and ttl<=0:
+            return
+        size=self.sizeof(key,value) if self.sizeof else 0
+        #单个条目就超过总大小上限的不保存
+        if self.maxbytes is not None and size>self.maxbytes:
+            return
+        expires=None if ttl is None else time.time()+ttl
+        self._data[key]=(value,expires,size)
+        self.bytes+=size
+        while len(self._data)>self.maxsize or (self.maxbytes is not None and self.bytes>self.maxbytes):
+            k,(v,e,n)=self._data.popitem(last=False)
+            self.bytes-=n
+            self.evictions+=1
+
+    #修改已有条目的值，过期时间不变，条目不存在或已过期时不保存，返回是否修改了
+    def replace(self,key,value):
+        item=self._data.get(key)
+        if item is None:
+            return False
+        v,expires,size=item
+        if expires is not None and expires<=time.time():
+            self._delete(key)
+            return False
+        self.set(key,value,None if expires is None else expires-time.time())
+        return key in self._data
+
+    def pop(self,key,default=None):
+        item=self._delete(key)
+        return default if item is None else item[0]
+
+    def _delete(self,key):
+        item=self._data.pop(key,None)
+        if item is not None:
+            self.bytes-=item[2]
+        return item
+
+    #删除所有满足条件的条目，fn(key,value)返回True则删除，返回删除的数量
+    def remove_if(self,fn):
+        keys=[k for k,(v,e,n) in self._data.items() if fn(k,v)]
+        for k in keys:
+            self._delete(k)
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
+        self.bytes=0
+
+    #没过期的(key,value)列表，不改变使用顺序，也不算命中
+    def items(self):
+        now=time.time()
+        return [(k,v) for k,(v,e,n) in self._data.items() if e is None or e>now]
+
+    #命中率等统计信息，用来调整缓存大小
+    def stats(self):
+        total=self.hits+self.misses
+        return dict(size=len(self._data),maxsize=self.maxsize,bytes=self.bytes,maxbytes=self.maxbytes,hits=self.hits,misses=self.misses,evictions=self.evictions,hit_rate=(self.hits/total if total else 0.0))
+
+_MISSING=object()
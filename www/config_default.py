@@ -4,14 +4,54 @@
 #默认配置文件
 configs={
     'debug':True,
+    'server':{
+        'host':'127.0.0.1',
+        'port':9000,
+        #worker进程数，0表示不启动master，在当前进程里运行
+        'workers':0
+    },
     'db':{
         'host':'127.0.0.1',
         'port':3306,
         'user':'www-data',
         'password':'www-data',
-        'db':'awesome'
+        'db':'awesome',
+        #count查询结果缓存的有效时间(秒)
+        'count_cache_ttl':60,
+        #超过这个时间(秒)的SQL写入慢查询日志
+        'slow_query_time':0.5,
+        #为True时记录每个请求里identity map省掉的查询
+        'identity_map_debug':False
+    },
+    'json':{
+        #API响应的json编码器：orjson/ujson/json，为None时用最快的可用编码器
+        'encoder':None,
+        #响应里有超过这么多条的列表时分块输出，不一次生成整个响应体
+        'stream_threshold':1000,
+        'chunk_size':500
+    },
+    'templates':{
+        #生产模式：不检查模板修改，启动时编译所有模板，编译结果保存在bytecode_cache目录
+        'production':False,
+        #为None时由jinja2在临时目录里建一个只有当前用户能访问(0700)的目录
+        #自己指定的目录必须属于运行的用户，并且组和其他用户不可写，否则不能启动
+        'bytecode_cache':None,
+        #模板片段缓存({% cache %})的条目数和默认有效时间(秒)
+        'fragment_cache_size':1000,
+        'fragment_cache_ttl':300
+    },
+    #匿名用户GET请求的整页缓存
+    'response_cache':{
+        'maxsize':10000,
+        'maxbytes':32*1024*1024,
+        #缓存是每个进程自己的，写博客、评论时只有处理请求的worker会删除缓存的页面
+        #多worker时缓存的有效时间不超过这么多秒，其他worker最多返回这么久的旧页面
+        'shared_ttl':5
     },
     'session':{
-        'secret':'Awesome'
+        'secret':'Awesome',
+        #已验证的cookie缓存的条目上限和有效时间(秒)
+        'cache_size':4096,
+        'cache_ttl':300
     }
 }
\ No newline at end of file
@@ -5,5 +5,8 @@
 configs={
     'db':{
         'host':'127.0.0.1'
+    },
+    'templates':{
+        'production':True
     }
 }
\ No newline at end of file
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import asyncio,os,inspect,functools
+import asyncio,os,inspect,functools,hashlib
+
+from email.utils import formatdate,parsedate_to_datetime
 
 import logging; logging.basicConfig(level=logging.DEBUG)
 
@@ -13,13 +15,15 @@ from apis import APIError
 
 #get和post为修饰方法，主要是为对象加上'__method__'和'__route__'属性
 #为了把我们定义的url实际处理方法，以get请求或post请求区分
-def get(path):
+#cache_ttl:匿名用户访问时整页缓存的有效时间(秒)，None表示不缓存
+def get(path,cache_ttl=None):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args,**kw):
             return func(*args,**kw)
         wrapper.__method__='GET'
         wrapper.__route__=path
+        wrapper.__cache_ttl__=cache_ttl
         return wrapper
     return decorator
 
@@ -99,75 +103,27 @@ class RequestHandler(object):
         self._has_named_kw_args=has_named_kw_args(fn)
         self._named_kw_args=get_named_kw_args(fn)
         self._request_kw_args=get_required_kw_args(fn)
-
+        #注册的路径，作为请求指标的route标签
+        self.route=getattr(fn,'__route__',None)
+        #整页缓存的有效时间，由cache_factory读取
+        self.cache_ttl=getattr(fn,'__cache_ttl__',None)
+        #参数分析只在这里做一次，每个请求只需要调用生成好的绑定函数
+        self._needs_params=bool(self._has_var_kw_arg or self._has_named_kw_args or self._request_kw_args)
+        self._bind=make_binder(self._has_request_arg,() if self._has_var_kw_arg else self._named_kw_args,self._request_kw_args)
+        logging.info('%s : has_request_arg=%s,has_var_kw_arg=%s,has_named_kw_args=%s,get_named_kw_args=%s,get_required_kw_args=%s'%(fn.__name__,self._has_request_arg,self._has_var_kw_arg,self._has_named_kw_args,self._named_kw_args,self._request_kw_args))
 
     @asyncio.coroutine
     def __call__(self,request):
-        kw=None
-        logging.info('%s : has_request_arg=%s,has_var_kw_arg=%s,has_named_kw_args=%s,get_named_kw_args=%s,get_required_kw_args=%s'%(__name__,self._has_request_arg,self._has_var_kw_arg,self._has_named_kw_args,self._named_kw_args,self._request_kw_args))
-        #如果处理函数需要传入特定的key的参数或者可变参数的话
-        if self._has_var_kw_arg or self._has_named_kw_args or self._request_kw_args:
-            #如果是post请求，则读请求的body
-            if request.method=='POST':
-                #如果request的头中没有Content-type，则返回错误描述
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content_type')
-                #字符串全部转为小写
-                ct=request.content_type.lower()
-                #如果是’application/json‘类型
-                if ct.startswith('application/json'):
-                    #把request的body，按json的方式输出为一个字典
-                    params=yield from request.json()
-                    #解读出错或params不是一个字典，则返回错误
-                    if not isinstance(params,dict):
-                        return web.HTTPBadRequest('JSON Body must be object')
-                    #保存这个params
-                    kw=params
-                #如果是'application/x-www-form-urlencoded'或'multipart/form-data'，直接读出来并保存
-                elif ct.startswith('application/x-www-form-urlencoded' or ct.startswith('multipart/form-data')):
-                    params=yield from request.post()
-                    kw=dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unsupported Content_type:%s'% request.content_type)
-            #如果是get请求，则读取url字符串
-            if request.method=='GET':
-                #看url有没有参数，即?后面的字符串
-                qs=request.query_string
-                logging.info('qs=%s'%qs)
-                #如果有的话，则把参数以键值的方式存起来赋值给kw
-                if qs:
-                    kw=dict()
-                    for k,v in parse.parse_qs(qs,True).items():
-                        kw[k]=v[0]
-        #如果kw为空的话，kw设置为request.match_info
-        if kw is None:
-            kw=dict(**request.match_info)
-            logging.info('kw=%s'%kw)
-        else:
-            #如果kw有值的话
-            #如果处理方法需要传入**kw，且需要传入关键字参数
-            if not self._has_var_kw_arg and self._named_kw_args:
-                copy=dict()
-                #从kw中筛选出url处理方法需要传入参数对
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name]=kw[name]
-                kw=copy
-            #从match_info中筛选出url处理方法需要传入的参数对
-            for k,v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args:%s'%k)
-                kw[k]=v
-        #如果参数需要传入'request'参数，则把request实例传入
-        if self._has_request_arg:
-            kw['request']=request
-
-        #如果参数有默认为None的关键字参数，遍历一下kw,如果kw中没有这个key,抛错
-        if self._request_kw_args:
-            for name in self._request_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument:%s'%name)
-        logging.info('call with args:%s'%str(kw))
+        #只有需要关键字参数的处理函数才去读query string或body
+        params=None
+        if self._needs_params:
+            params=yield from read_params(request)
+            if isinstance(params,web.StreamResponse):
+                return params
+        kw=self._bind(request,params)
+        if isinstance(kw,web.StreamResponse):
+            return kw
+        logging.debug('call with args:%s',kw)
         try:
             #对url进行处理
             r=yield from self._func(**kw)
@@ -175,6 +131,131 @@ class RequestHandler(object):
         except APIError as e:
             return dict(error=e.error,data=e.data,message=e.message)
 
+#读取请求的参数：POST请求读body，GET请求读query string，没有参数返回None
+#参数不对的话返回web.HTTPBadRequest
+@asyncio.coroutine
+def read_params(request):
+    #如果是post请求，则读请求的body
+    if request.method=='POST':
+        #如果request的头中没有Content-type，则返回错误描述
+        if not request.content_type:
+            return web.HTTPBadRequest('Missing Content_type')
+        #字符串全部转为小写
+        ct=request.content_type.lower()
+        #如果是’application/json‘类型，把request的body，按json的方式输出为一个字典
+        if ct.startswith('application/json'):
+            params=yield from request.json()
+            #解读出错或params不是一个字典，则返回错误
+            if not isinstance(params,dict):
+                return web.HTTPBadRequest('JSON Body must be object')
+            return params
+        #如果是'application/x-www-form-urlencoded'或'multipart/form-data'，直接读出来
+        if ct.startswith(('application/x-www-form-urlencoded','multipart/form-data')):
+            params=yield from request.post()
+            return dict(**params)
+        return web.HTTPBadRequest('Unsupported Content_type:%s'% request.content_type)
+    #如果是get请求，则读取url的?后面的字符串，同名参数取第一个
+    if request.method=='GET':
+        qs=request.query_string
+        if qs:
+            params=dict()
+            for k,v in parse.parse_qsl(qs,True):
+                if k not in params:
+                    params[k]=v
+            return params
+    return None
+
+#根据RequestHandler分析出的参数信息，为一个url处理函数生成专门的参数绑定函数
+#bind(request,params)返回调用url处理函数用的kw，缺少必须的参数时返回web.HTTPBadRequest
+#has_request:是否需要传入request
+#names:需要从params中筛选出来的命名关键字参数，为空则params全部传入
+#required:必须传入的命名关键字参数
+def make_binder(has_request,names,required):
+    def bind(request,params):
+        match_info=request.match_info
+        if params is None:
+            kw=dict(match_info)
+        else:
+            kw={name:params[name] for name in names if name in params} if names else params
+            #match_info中的参数优先
+            for k in match_info:
+                if k in kw:
+                    logging.warning('Duplicate arg name in named arg and kw args:%s'%k)
+            kw.update(match_info)
+        if has_request:
+            kw['request']=request
+        for name in required:
+            if name not in kw:
+                return web.HTTPBadRequest('Missing argument:%s'%name)
+        return kw
+    return bind
+
+#根据body生成强ETag
+def make_etag(body):
+    return '"%s"'%hashlib.sha1(body).hexdigest()
+
+#判断客户端缓存的版本是否还有效
+#有If-None-Match时只比较ETag，否则比较If-Modified-Since和last_modified(时间戳)
+def is_not_modified(request,etag,last_modified=None):
+    inm=request.headers.get('If-None-Match')
+    if inm is not None:
+        if inm.strip()=='*':
+            return True
+        #弱比较，忽略W/前缀
+        tags=[t.strip() for t in inm.split(',')]
+        tags=[t[2:] if t.startswith('W/') else t for t in tags]
+        return (etag[2:] if etag.startswith('W/') else etag) in tags
+    ims=request.headers.get('If-Modified-Since')
+    if ims is not None and last_modified is not None:
+        try:
+            return int(last_modified)<=parsedate_to_datetime(ims).timestamp()
+        except (TypeError,ValueError) as e:
+            return False
+    return False
+
+#构造带ETag和Last-Modified的响应，客户端缓存的版本没变则返回不带body的304
+#etag为空时根据body生成
+def conditional_response(request,body,content_type,etag=None,last_modified=None):
+    if etag is None:
+        etag=make_etag(body)
+    headers={'ETag':etag}
+    if last_modified:
+        headers['Last-Modified']=formatdate(last_modified,usegmt=True)
+    if is_not_modified(request,etag,last_modified):
+        return web.Response(status=304,headers=headers)
+    headers['Content-Type']=content_type
+    return web.Response(body=body,headers=headers)
+
+#模板和静态文件内容的sha1，启动时算一次
+#handler的版本号只反映数据，部署了新的模板或静态文件后html也变了，所以ETag里要带上它
+def deploy_version():
+    h=hashlib.sha1()
+    base=os.path.dirname(os.path.abspath(__file__))
+    for d in ('templates','static'):
+        for root,dirs,files in os.walk(os.path.join(base,d)):
+            dirs.sort()
+            for f in sorted(files):
+                path=os.path.join(root,f)
+                h.update(os.path.relpath(path,base).encode('utf-8'))
+                with open(path,'rb') as fp:
+                    h.update(fp.read())
+    return h.hexdigest()[:12]
+
+_DEPLOY_VERSION=deploy_version()
+
+#用版本号作为这次响应的ETag(弱ETag)，这样的响应不发Last-Modified
+def set_version(request,version):
+    request.__etag__='W/"%s-%s"'%(version,_DEPLOY_VERSION)
+    return request.__etag__
+
+#handler在加载完整数据之前，先用一个便宜的版本号检查客户端缓存
+#版本没变返回304响应，handler直接返回它即可；否则返回None，并且这个版本号会作为这次响应的ETag
+def not_modified(request,version):
+    etag=set_version(request,version)
+    if is_not_modified(request,etag):
+        return web.Response(status=304,headers={'ETag':etag})
+    return None
+
 #添加静态页面路径
 def add_static(app):
     path=os.path.join(os.path.dirname(os.path.abspath(__file__)),'static')
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__='Wby'
+
+'''
+Jinja2 fragment cache.
+
+    {% cache 'comments:' ~ blog.id ~ ':' ~ comments_version, 120 %}
+        ...
+    {% endcache %}
+
+The key carries the version of the data it renders, so a changed
+fragment is looked up under a new key and the old one just expires.
+'''
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from cache import LRUCache
+
+#模板片段缓存，key里带上数据的版本号，数据变了就用新的key，旧的片段等过期
+class FragmentCache(object):
+    """docstring for FragmentCache"""
+    def __init__(self, maxsize=1000,ttl=300):
+        #key->html
+        self.cache=LRUCache(maxsize,ttl)
+
+    def get(self,key):
+        return self.cache.get(key)
+
+    def set(self,key,html,ttl=None):
+        self.cache.set(key,html,ttl)
+
+    def stats(self):
+        return self.cache.stats()
+
+#{% cache key[, ttl] %}...{% endcache %}
+#key:片段的key，ttl:有效时间(秒)，为空则用默认值
+class FragmentCacheExtension(Extension):
+    """docstring for FragmentCacheExtension"""
+    tags=set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self,parser):
+        lineno=next(parser.stream).lineno
+        args=[parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body=parser.parse_statements(['name:endcache'],drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache',args),[],[],body).set_lineno(lineno)
+
+    def _cache(self,key,ttl,caller):
+        cache=self.environment.fragment_cache
+        html=cache.get(key)
+        if html is None:
+            html=caller()
+            cache.set(key,html,ttl)
+        return html
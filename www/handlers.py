@@ -6,14 +6,16 @@ __author__='Wby'
 
 import re,time,json,logging,hashlib,base64,asyncio
 
-from coroweb import get,post
+from coroweb import get,post,not_modified,set_version
 from aiohttp import web
 
+import orm,metrics,jsonenc,advisor
 from models import User,Comment,Blog,next_id
+from cache import LRUCache
 
 from config import configs
 
-from apis import Page,APIValueError,APIResourceNotFoundError,APIError
+from apis import Page,CursorPage,APIValueError,APIResourceNotFoundError,APIError
 import markdown2
 logging.basicConfig(level=logging.INFO)
 
@@ -25,6 +27,24 @@ _RE_SHA1=re.compile(r'^[0-9a-f]{40}$')
 COOKIE_NAME='awesession'
 _COOKIE_KEY=configs.session.secret
 
+#cookie字符串->已验证的user，避免每个请求都去数据库查一次用户
+_SESSION_CACHE=LRUCache(configs.session.cache_size,configs.session.cache_ttl)
+
+#用户数据变更时，删除该用户所有缓存的cookie
+#注意：缓存是进程内的，其他进程只能等ttl过期
+def _drop_sessions(action,user):
+    uid=user.getValue(user.__primary_key__)
+    n=_SESSION_CACHE.remove_if(lambda k,v:v.id==uid)
+    if n:
+        logging.info('drop %s cached sessions of user:%s'%(n,uid))
+
+orm.add_listener(User,_drop_sessions)
+metrics.register_collector(metrics.cache_collector('session',_SESSION_CACHE))
+
+#session缓存的命中统计
+def session_cache_stats():
+    return _SESSION_CACHE.stats()
+
 #检测当前用户是不是admin用户
 def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
@@ -41,11 +61,66 @@ def get_page_index(page_str):
            p=1
     return p
 
+#博客或评论修改后，删除这些路径的整页缓存(包括带query string的)
+#缓存是进程内的，多worker时其他worker的缓存只能等ttl过期，见app.cache_factory
+def invalidate_pages(request,*paths):
+    cache=request.app.get('__response_cache__')
+    if cache is None:
+        return
+    n=cache.remove_if(lambda k,v:k.split('?',1)[0] in paths)
+    logging.info('invalidate %s cached pages of %s'%(n,paths))
+
+#某条博客相关的页面
+def blog_pages(blog_id):
+    return ('/','/api/blogs','/blog/%s'%blog_id,'/api/blogs/%s'%blog_id)
+
+#给评论加上所属博客的标题(blog_name)，所有博客一次查出来(只查标题)，博客已删除的为空
+@asyncio.coroutine
+def attach_blog_names(comments):
+    blogs,missing=yield from Blog.findMany([c.blog_id for c in comments],columns=['name'])
+    names=dict((b.id,b.name) for b in blogs)
+    for c in comments:
+        c['blog_name']=names.get(c.blog_id,'')
+
+#游标分页查询，cursor是上一页返回的next_cursor，返回(CursorPage,条目列表)
+#columns:只查询这些列，见Model.selectColumns
+@asyncio.coroutine
+def find_page_by_cursor(model,cursor,columns=None):
+    p=CursorPage(cursor)
+    try:
+        items=yield from model.findAll(cursor=cursor,limit=p.limit,columns=columns)
+    except ValueError as e:
+        raise APIValueError('cursor','Invalid cursor')
+    return p,p.apply(items)
+
 #把纯文本文件转换为html格式的文本
 def text2html(text):
     lines=map(lambda s:'<p>%s</p>'%s.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;'),filter(lambda s:s.strip()!='',text.split('\n')))
     return ''.join(lines)
 
+#markdown2的渲染参数，修改后要把_RENDERER_VERSION加1，已保存的html会在下次访问时重新渲染
+_MARKDOWN_EXTRAS=[]
+_RENDERER_VERSION=1
+
+#博客正文的hash，用来判断正文有没有修改
+def content_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+#把博客正文渲染成html保存到blog上，previous是修改前的博客，正文没变的话直接沿用它的html
+#设置的是dict里的值，json编码和Model.update用的都是它(Model的__setattr写错了名字，blog.x=...只设置实例属性)
+#返回True说明重新渲染过
+def render_blog(blog,previous=None):
+    h=content_hash(blog.content)
+    if previous is not None and previous.content_hash==h and previous.renderer_version==_RENDERER_VERSION and previous.html_content:
+        blog['html_content']=previous.html_content
+        rendered=False
+    else:
+        blog['html_content']=markdown2.markdown(blog.content,extras=_MARKDOWN_EXTRAS)
+        rendered=True
+    blog['content_hash']=h
+    blog['renderer_version']=_RENDERER_VERSION
+    return rendered
+
 #根据用户信息拼接一个cookies字符串
 def user2cookie(user,max_age):
     #build cookie string by:id-expires-sha1
@@ -73,7 +148,12 @@ def cookie2user(cookie_str):
         uid,expires,sha1=L
         #如果超时返回None
         if int(expires)<time.time():
+            _SESSION_CACHE.pop(cookie_str)
             return None
+        #先查缓存，命中的话返回一个副本，防止请求里修改了缓存的user
+        cached=_SESSION_CACHE.get(cookie_str)
+        if cached is not None:
+            return User(**cached)
         #根据用户id查找数据库，对比有没有该用户
         user=yield from User.find(uid)
         #如果没有该用户返回None
@@ -85,7 +165,13 @@ def cookie2user(cookie_str):
         if sha1!=hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
-        user.passwd='******'
+        #Model的__setattr写错了名字，user.passwd=...只会设置实例属性，dict里的值(json和User(**user)用的)还是密码的hash
+        user['passwd']='******'
+        #缓存验证过的user，有效时间不超过cookie的过期时间
+        ttl=int(expires)-time.time()
+        if _SESSION_CACHE.ttl is not None:
+            ttl=min(ttl,_SESSION_CACHE.ttl)
+        _SESSION_CACHE.set(cookie_str,User(**user),ttl)
         #返回合法的user
         return user
     except Exception as e:
@@ -112,12 +198,20 @@ def index(*,page='1'):
 '''
 
 #首页，会显示博客列表
-@get('/')
-def index(*,page='1'):
+@get('/',cache_ttl=60)
+def index(*,page='1',cursor=None):
+    #带cursor的话用游标分页，翻到很后面的页也不会变慢
+    if cursor is not None:
+        page,blogs=yield from find_page_by_cursor(Blog,cursor)
+        return {
+            '__template__':'blogs.html',
+            'page':page,
+            'blogs':blogs
+        }
     #获取到要展示的博客页数是第几页
     page_index=get_page_index(page)
     #查找博客表里面的条目数
-    num=yield from Blog.findNumber('count(id)')
+    num=yield from Blog.count()
     #通过Page类来计算当前页的相关信息
     page=Page(num,page_index)
     #如果表里没有条目，则不需要显示
@@ -125,7 +219,8 @@ def index(*,page='1'):
         blogs=[]
     else:
         #否则，根据计算出来的offset(取的初始条目index)和limit(取的条数)，来取出条目
-        blogs=yield from Blog.findAll(orderBy='created_at desc',limit=(page.offset,page.limit))
+        #首页只读，用紧凑的Record对象
+        blogs=yield from Blog.findAll(orderBy='created_at desc',limit=(page.offset,page.limit),compact=True)
     #返回给浏览器
     return {
         '__template__':'blogs.html',
@@ -155,18 +250,35 @@ def api_get_users(request):
     return dict(users=users)
 '''
 
+#索引建议：运行以来findAll/findNumber用过的查询条件和排序，哪些用不上索引
+#只统计当前进程的查询，多进程时每个worker各自统计
+@get('/api/index_advice')
+def api_index_advice(request):
+    check_admin(request)
+    shapes=yield from advisor.advise()
+    return dict(shapes=shapes)
+
+#用户列表查询的列，不包括密码的hash
+_USER_COLUMNS=[f for f in User.__fields__ if f!='passwd']
+
 #返回所有用户信息
 @get('/api/users')
-def api_get_users(*,page='1'):
+def api_get_users(*,page='1',cursor=None):
+    if cursor is not None:
+        #不查询密码的hash，返回的passwd固定为******
+        p,users=yield from find_page_by_cursor(User,cursor,_USER_COLUMNS)
+        for u in users:
+            u['passwd']='******'
+        return dict(page=p,users=users)
     page_index=get_page_index(page)
-    num=yield from User.findNumber('count(id)')
+    num=yield from User.count(estimate=True)
     p=Page(num,page_index)
     if num==0:
         return dict(page=p,users=())
-    users=yield from User.findAll(orderBy='created_at desc',limit=(p.offset,p.limit))
+    users=yield from User.findAll(orderBy='created_at desc',limit=(p.offset,p.limit),columns=_USER_COLUMNS)
     logging.info('users=%s and type=%s'%(users,type(users)))
     for u in users:
-        u.passwd='******'
+        u['passwd']='******'
     return dict(page=p,users=users)
 
 #注册页面
@@ -188,6 +300,7 @@ def signin():
 def signout(request):
     referer=request.headers.get('Referer')
     r=web.HTTPFound(referer or '/')
+    _SESSION_CACHE.pop(request.cookies.get(COOKIE_NAME))
     #清理掉cookie等用户信息数据
     r.set_cookie(COOKIE_NAME,'-deleted-',max_age=0,httponly=True)
     logging.info('user signed out')
@@ -206,11 +319,6 @@ def api_register_user(*,email,name,passwd):
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
 
-    #查一下库里是否有相同的email地址，如果有则提示用户email已经被注册过
-    users=yield from User.findAll('email=?',[email])
-    if len(users)>0:
-        raise APIError('register:failed','email','Email is already in use.')
-
     #生成一个当前要注册用户的唯一uid
     uid=next_id()
     #构建sha1_passwd
@@ -223,19 +331,22 @@ def api_register_user(*,email,name,passwd):
     #创建一个用户(密码是通过sha1加密保存)
     user=User(id=uid,name=name.strip(),email=email,passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(),image = 'http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest(), admin=admin)
 
-    #保存这个用户到数据库用户表中
-    yield from user.save()
+    #保存这个用户到数据库用户表中，email有唯一索引(idx_email)，已经被注册过的话不会插入
+    inserted=yield from user.insertIgnore()
+    if not inserted:
+        raise APIError('register:failed','email','Email is already in use.')
     logging.info('save user OK')
     #构建返回信息
     r=web.Response()
     #添加cookie
     r.set_cookie(COOKIE_NAME,user2cookie(user,86400),max_age=86400,httponly=True)
     #只把要返回的实例的密码改成'******',库里的密码依然是正确的，以保证真实密码不会因返回而暴漏
-    user.passwd='******'
+    #要改dict里的值，json编码的是它(见cookie2user)
+    user['passwd']='******'
     #返回的是json数据，所有设置content-type为json
     r.content_type='application/json'
     #把对象转换成json格式返回
-    r.body=json.dumps(user,ensure_ascii=False).encode('utf-8')
+    r.body=jsonenc.dumps(user)
     return r
 
 #登录请求
@@ -267,9 +378,9 @@ def authenticate(*,email,passwd):
     r=web.Response()
     #添加cookie
     r.set_cookie(COOKIE_NAME,user2cookie(user,86400),max_age=86400,httponly=True)
-    user.passwd='******'
+    user['passwd']='******'
     r.content_type='application/json'
-    r.body=json.dumps(user,ensure_ascii=False).encode('utf-8')
+    r.body=jsonenc.dumps(user)
     return r
 
 #管理页面
@@ -287,13 +398,18 @@ def manage_comments(*,page='1'):
 
 #根据page获取评论，注释可参看index函数的注释
 @get('/api/comments')
-def api_comments(*,page='1'):
+def api_comments(*,page='1',cursor=None):
+    if cursor is not None:
+        p,comments=yield from find_page_by_cursor(Comment,cursor)
+        yield from attach_blog_names(comments)
+        return dict(page=p,comments=comments)
     page_index=get_page_index(page)
-    num=yield from Comment.findNumber('count(id)')
+    num=yield from Comment.count(estimate=True)
     p=Page(num,page_index)
     if num==0:
         return dict(page=p,comments=())
     comments=yield from Comment.findAll(orderBy='created_at desc',limit=(p.offset,p.limit))
+    yield from attach_blog_names(comments)
     return dict(page=p,comments=comments)
 
 #对某个博客发表评论
@@ -315,6 +431,7 @@ def api_create_comment(id,request,*,content):
     comment=Comment(blog_id=blog.id,user_id=user.id,user_name=user.name,user_image=user.image,content=content.strip())
     #保存到评论里面
     yield from comment.save()
+    invalidate_pages(request,'/blog/%s'%blog.id)
     return comment
 
 #删除某个评论
@@ -330,6 +447,7 @@ def api_delete_comments(id,request):
         raise APIResourceNotFoundError('Comment')
     #有的话删除
     yield from c.remove()
+    invalidate_pages(request,'/blog/%s'%c.blog_id)
     return dict(id=id)
 
 #写博客页面
@@ -359,10 +477,13 @@ def manage_users(*,page='1'):
     }
 
 #获取博客信息
-@get('/api/blogs')
-def api_blogs(*,page='1'):
+@get('/api/blogs',cache_ttl=60)
+def api_blogs(*,page='1',cursor=None):
+    if cursor is not None:
+        p,blogs=yield from find_page_by_cursor(Blog,cursor)
+        return dict(page=p,blogs=blogs)
     page_index=get_page_index(page)
-    num=yield from Blog.findNumber('count(id)')
+    num=yield from Blog.count()
     p=Page(num,page_index)
     if num==0:
         return dict(page=p,blogs=())
@@ -382,58 +503,112 @@ def api_create_blog(request,*,id,name,summary,content):
     if not content or not content.strip():
         raise APIValueError('content','content cannot be empty')
 
-    #根据ID查询一下数据库，如果没有则插入，如果有，则只进行更新
-    blog=yield from Blog.find(id)
-    if blog is None:
-        #根据传入的信息构建了一条博客数据
-        insertblog=Blog(user_id=request.__user__.id,user_name=request.__user__.name,user_image=request.__user__.image,name=name.strip(),summary=summary.strip(),content=content.strip())
-        #保存
-        yield from insertblog.save()
-        return insertblog
+    #根据传入的信息构建了一条博客数据
+    blog=Blog(user_id=request.__user__.id,user_name=request.__user__.name,user_image=request.__user__.image,name=name.strip(),summary=summary.strip(),content=content.strip())
+    #修改已有的博客时只查渲染需要的几列，正文没变的话沿用原来的html
+    previous=None
+    if id:
+        blogs,missing=yield from Blog.findMany([id],columns=['content_hash','renderer_version','html_content'])
+        previous=blogs[0] if blogs else None
+    render_blog(blog,previous)
+    if previous is None:
+        #新博客的id总是由服务端生成，不使用客户端传来的id
+        yield from blog.save()
     else:
-        #根据传入的信息和查询到的信息构建了一条博客数据
-        editblog=Blog(id=blog.id,user_id=request.__user__.id,user_name=request.__user__.name,user_image=request.__user__.image,name=name.strip(),summary=summary.strip(),content=content.strip())
-        #修改
-        yield from editblog.update()
-        return editblog
+        #修改：只更新设置了的列，created_at保持第一次发表的时间
+        #不用upsert，博客在这之间被删除的话不会重新插入
+        blog['id']=previous.id
+        yield from blog.update()
+    invalidate_pages(request,*blog_pages(blog.id))
+    return blog
+
+#博客页面的版本号：正文、标题摘要、作者、评论、渲染版本和当前用户任何一个变了，版本号都会变
+#b是博客的content_hash-renderer_version-md5(标题摘要作者)，c是评论数-最新的评论id(next_id按时间递增)
+def make_blog_version(b,c,user):
+    s='%s|%s|%s|%s'%(b,c,user.id if user else '',_RENDERER_VERSION)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+#只查几个小字段算出版本号，不需要加载正文和所有评论，博客不存在返回None
+@asyncio.coroutine
+def blog_version(id,user):
+    b=yield from Blog.findNumber("concat(`content_hash`,'-',`renderer_version`,'-',md5(concat(`name`,`summary`,`user_name`,`user_image`)))",'`id`=?',[id])
+    if b is None:
+        return None
+    c=yield from Comment.findNumber("concat(count(`id`),'-',coalesce(max(`id`),''))",'`blog_id`=?',[id])
+    return make_blog_version(b,c,user)
+
+#已经加载的博客的版本，和blog_version里查出来的b一样
+def blog_row_version(blog):
+    h=hashlib.md5(('%s%s%s%s'%(blog.name,blog.summary,blog.user_name,blog.user_image)).encode('utf-8')).hexdigest()
+    return '%s-%s-%s'%(blog.content_hash,blog.renderer_version,h)
+
+#已经加载的评论的版本，和blog_version里查出来的c一样
+def comments_version(comments):
+    return '%s-%s'%(len(comments),max(c.id for c in comments) if comments else '')
 
 #进入某条博客
-@get('/blog/{id}')
-def get_blog(id):
+#版本号作为ETag，不发Last-Modified：created_at在修改博客后不变，只带If-Modified-Since的客户端会拿到错误的304
+@get('/blog/{id}',cache_ttl=300)
+def get_blog(id,request):
+    #客户端带了If-None-Match才先查版本号，缓存的页面没变的话直接返回304
+    if 'If-None-Match' in request.headers:
+        version=yield from blog_version(id,request.__user__)
+        if version is not None:
+            r=not_modified(request,version)
+            if r is not None:
+                return r
     #根据博客id查询博客信息
     blog=yield from Blog.find(id)
     #根据博客id查询该条博客的评论
     comments=yield from Comment.findAll('blog_id=?',[id],orderBy='created_at desc')
-    #markdown2是一个扩展模块，这里把博客正文和评论嵌套在markdown2里面
     for c in comments:
         c.html_content=text2html(c.content)
-    blog.html_content=markdown2.markdown(blog.content)
-    #返回页面
+    #没带If-None-Match的请求也用版本号作为ETag，从已经加载的数据算出来，不用再查数据库
+    #在重新渲染之前算，和blog_version查出来的一样
+    b=blog_row_version(blog)
+    c=comments_version(comments)
+    #博客正文的html在保存时已经渲染好了，旧数据或者渲染参数变了的话只在内存里重新渲染，
+    #GET请求不写数据库，数据库里的html由修改博客时或迁移脚本更新
+    if blog.renderer_version!=_RENDERER_VERSION or not blog.html_content:
+        render_blog(blog)
+    set_version(request,make_blog_version(b,c,request.__user__))
+    #返回页面，模板片段缓存的key带上版本，数据变了key就变了，不用通知每个worker删除缓存
     return {
         '__template__':'blog.html',
         'blog':blog,
-        'comments':comments
+        'comments':comments,
+        'blog_version':b,
+        'comments_version':c
     }
 
 #获取某条博客信息
-@get('/api/blogs/{id}')
+@get('/api/blogs/{id}',cache_ttl=300)
 def opi_get_blog(*,id):
     blog=yield from Blog.find(id)
     return blog
 
+#删除博客和它的所有评论，在事务里调用
+@asyncio.coroutine
+def delete_blog(id):
+    #查询一下博客id是否有对应的博客
+    blog=yield from Blog.find(id)
+    #如果没有抛错
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    #评论用一条delete语句删除，不用先查出来一条一条删
+    yield from Comment.removeAll('`blog_id`=?',[id])
+    #删除博客
+    yield from blog.remove()
+
 #删除某条博客
 @post('/api/blogs/{id}/delete')
 def api_delete_blog(id,request):
     logging.info(id)
-    #先检查是否是管理员现场，只有管理员才有删除评论权限
+    #先检查是否是管理员现场，只有管理员才有删除博客权限
     check_admin(request)
-    #查询一下评论id是否有对应的评论
-    c=yield from Blog.find(id)
-    #如果没有抛错
-    if c is None:
-        raise APIResourceNotFoundError('Blog')
-    #有的话删除
-    yield from c.remove()
+    #博客和它的评论在一个事务里删除，只提交一次
+    yield from orm.in_transaction(delete_blog,id)
+    invalidate_pages(request,*blog_pages(id))
     return dict(id=id)
 
 #编辑博客页面
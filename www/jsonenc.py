@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__='Wby'
+
+'''
+JSON encoding for API responses.
+
+Uses orjson or ujson when installed, otherwise the json module (C accelerated).
+'''
+
+import json,decimal
+
+#不能直接编码的对象：有__json__方法的(Page等)用它返回的dict，其余的和以前一样用__dict__
+def _default(o):
+    fn=getattr(o,'__json__',None)
+    if fn is not None:
+        return fn()
+    if isinstance(o,decimal.Decimal):
+        return float(o)
+    if isinstance(o,(set,frozenset)):
+        return list(o)
+    if hasattr(o,'__dict__'):
+        return o.__dict__
+    raise TypeError('%r is not JSON serializable'%o)
+
+#各个编码器，都返回utf-8的bytes，中文不转义
+#Model是dict的子类，几个编码器都直接按dict编码，不会走_default
+def _json_dumps():
+    encoder=json.JSONEncoder(ensure_ascii=False,separators=(',',':'),default=_default)
+    return lambda obj:encoder.encode(obj).encode('utf-8')
+
+def _orjson_dumps():
+    import orjson
+    return lambda obj:orjson.dumps(obj,default=_default)
+
+def _ujson_dumps():
+    import ujson
+    #旧版本的ujson不支持default参数
+    ujson.dumps(decimal.Decimal(1),default=_default)
+    return lambda obj:ujson.dumps(obj,ensure_ascii=False,escape_forward_slashes=False,default=_default).encode('utf-8')
+
+_BACKENDS=dict(orjson=_orjson_dumps,ujson=_ujson_dumps,json=_json_dumps)
+
+#可用的编码器名字，按速度排序
+def available():
+    r=[]
+    for name in ('orjson','ujson','json'):
+        try:
+            _BACKENDS[name]()
+        except (ImportError,TypeError):
+            continue
+        r.append(name)
+    return r
+
+#切换编码器，name为None时用最快的可用编码器，返回实际使用的编码器名字
+def use(name=None):
+    global dumps,ENCODER
+    for n in ([name] if name else available()):
+        dumps=_BACKENDS[n]()
+        ENCODER=n
+        return n
+
+ENCODER=None
+dumps=None
+use()
+
+#对象里有没有超过threshold条的列表，有的话适合用iterdumps分块输出
+def has_large_list(obj,threshold):
+    if isinstance(obj,(list,tuple)):
+        return len(obj)>threshold
+    if isinstance(obj,dict):
+        return any(isinstance(v,(list,tuple)) and len(v)>threshold for v in obj.values())
+    return False
+
+#分块编码，大列表每chunk_size条编码一次，不用一次生成整个响应体
+#输出的内容和dumps一样
+def iterdumps(obj,chunk_size=500):
+    if isinstance(obj,(list,tuple)):
+        if len(obj)<=chunk_size:
+            yield dumps(obj)
+            return
+        yield b'['
+        for i in range(0,len(obj),chunk_size):
+            if i>0:
+                yield b','
+            #去掉每块两边的[]
+            yield dumps(obj[i:i+chunk_size])[1:-1]
+        yield b']'
+    elif type(obj) is dict:
+        yield b'{'
+        for i,(k,v) in enumerate(obj.items()):
+            yield (b',' if i else b'')+dumps(str(k))+b':'
+            yield from iterdumps(v,chunk_size)
+        yield b'}'
+    else:
+        yield dumps(obj)
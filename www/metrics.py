@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__='Wby'
+
+'''
+In-process metrics.
+'''
+
+import bisect
+
+from collections import OrderedDict
+
+#默认的耗时分桶上限(秒)
+DEFAULT_BUCKETS=(0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+#固定分桶的直方图，observe只是一次二分查找和几次加法，可以放在每个请求/每条SQL上
+class Histogram(object):
+    """Fixed-bucket histogram"""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets=tuple(buckets)
+        #counts[i]是落在(buckets[i-1],buckets[i]]里的次数，最后一个是大于所有上限的次数
+        self.counts=[0]*(len(self.buckets)+1)
+        self.count=0
+        self.sum=0.0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.buckets,value)]+=1
+        self.count+=1
+        self.sum+=value
+
+    #估算百分位数，返回该百分位所在分桶的上限，超过所有分桶则返回inf
+    def percentile(self,p):
+        if self.count==0:
+            return 0.0
+        rank=self.count*p/100.0
+        n=0
+        for i,c in enumerate(self.counts):
+            n+=c
+            if n>=rank:
+                return self.buckets[i] if i<len(self.buckets) else float('inf')
+        return float('inf')
+
+    #累计计数，[(上限,小于等于上限的次数),...]，最后一个上限为inf
+    def cumulative(self):
+        r=[]
+        n=0
+        for le,c in zip(self.buckets+(float('inf'),),self.counts):
+            n+=c
+            r.append((le,n))
+        return r
+
+    def snapshot(self):
+        return dict(count=self.count,sum=self.sum,buckets=self.cumulative(),p50=self.percentile(50),p99=self.percentile(99))
+
+#指标收集函数列表，每个函数返回[(指标名,类型,说明,[(后缀,标签dict,值),...]),...]
+#/metrics被访问时才调用，平时不产生开销
+_collectors=[]
+
+def register_collector(fn):
+    _collectors.append(fn)
+
+#把一个直方图展开成prometheus的_bucket/_sum/_count样本
+def histogram_samples(labels,hist):
+    for le,n in hist.cumulative():
+        yield ('_bucket',dict(labels,le='+Inf' if le==float('inf') else repr(le)),n)
+    yield ('_sum',labels,hist.sum)
+    yield ('_count',labels,hist.count)
+
+def _escape(v):
+    return str(v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}'%','.join('%s="%s"'%(k,_escape(v)) for k,v in sorted(labels.items()))
+
+#生成prometheus文本格式的所有指标，不同收集函数返回的同名指标合并输出
+def render():
+    families=OrderedDict()
+    for fn in _collectors:
+        for name,kind,help,samples in fn():
+            if name not in families:
+                families[name]=(kind,help,[])
+            families[name][2].extend(samples)
+    lines=[]
+    for name,(kind,help,samples) in families.items():
+        lines.append('# HELP %s %s'%(name,help))
+        lines.append('# TYPE %s %s'%(name,kind))
+        for suffix,labels,value in samples:
+            lines.append('%s%s%s %s'%(name,suffix,_format_labels(labels),value))
+    return '\n'.join(lines)+'\n'
+
+#请求数，(method,route,status)->次数
+_requests={}
+#请求耗时，(method,route)->Histogram
+_request_time={}
+#正在处理的请求数
+_in_flight=0
+#模板渲染耗时，模板名->Histogram
+_template_time={}
+
+def request_started():
+    global _in_flight
+    _in_flight+=1
+
+#记录一个处理完的请求，route是注册时的路径(如/blog/{id})，避免每个不同的url都产生一组指标
+def request_finished(method,route,status,elapsed):
+    global _in_flight
+    _in_flight-=1
+    key=(method,route,status)
+    _requests[key]=_requests.get(key,0)+1
+    h=_request_time.get((method,route))
+    if h is None:
+        h=_request_time[(method,route)]=Histogram()
+    h.observe(elapsed)
+
+def observe_template(name,elapsed):
+    h=_template_time.get(name)
+    if h is None:
+        h=_template_time[name]=Histogram()
+    h.observe(elapsed)
+
+def _collect_requests():
+    return [
+        ('http_requests_total','counter','Total HTTP requests.',[('',dict(method=m,route=r,status=s),n) for (m,r,s),n in _requests.items()]),
+        ('http_request_duration_seconds','histogram','HTTP request latency.',[x for (m,r),h in _request_time.items() for x in histogram_samples(dict(method=m,route=r),h)]),
+        ('http_requests_in_flight','gauge','HTTP requests being processed.',[('',{},_in_flight)]),
+        ('template_render_seconds','histogram','Jinja2 template render time.',[x for t,h in _template_time.items() for x in histogram_samples(dict(template=t),h)])
+    ]
+
+register_collector(_collect_requests)
+
+#把LRUCache的统计信息转成指标，name是缓存的名字
+def cache_collector(name,cache):
+    def collect():
+        st=cache.stats()
+        labels=dict(cache=name)
+        return [
+            ('cache_hits_total','counter','Cache hits.',[('',labels,st['hits'])]),
+            ('cache_misses_total','counter','Cache misses.',[('',labels,st['misses'])]),
+            ('cache_evictions_total','counter','Cache evictions.',[('',labels,st['evictions'])]),
+            ('cache_entries','gauge','Cache entries.',[('',labels,st['size'])]),
+            ('cache_bytes','gauge','Cache size in bytes.',[('',labels,st['bytes'])])
+        ]
+    return collect
@@ -0,0 +1,9 @@
+-- 001_blog_html.sql
+-- 保存博客时预先渲染好html，已有的数据renderer_version为0，会在第一次访问时重新渲染
+
+use awesome;
+
+alter table blogs
+    add column `html_content` mediumtext not null after `content`,
+    add column `content_hash` varchar(40) not null default '' after `html_content`,
+    add column `renderer_version` bigint not null default 0 after `content_hash`;
@@ -0,0 +1,8 @@
+-- 002_comment_indexes.sql
+-- 博客页面按blog_id查评论并按created_at排序，博客版本号按blog_id统计评论数和最新评论时间
+-- 没有索引时每次都要扫描整个comments表
+
+use awesome;
+
+alter table comments
+    add key `idx_blog_id_created_at` (`blog_id`,`created_at`);
@@ -9,7 +9,7 @@ __author__='Wby'
 
 import time,uuid
 
-from orm import Model,StringField,BooleanField,FloatField,TextField
+from orm import Model,StringField,BooleanField,FloatField,TextField,IntegerField
 
 def next_id():
 	return '%015d%s000'%(int(time.time()*1000),uuid.uuid4().hex)
@@ -30,6 +30,8 @@ class User(Model):
 class Blog(Model):
 	"""class of Blog"""
 	__table__='blogs'
+	#热门博客被大量同时访问时，相同的查询只执行一次
+	__coalesce__=True
 
 	id=StringField(primary_key=True,default=next_id,ddl='varchar(50)')
 	user_id=StringField(ddl='varchar(50)')
@@ -37,12 +39,18 @@ class Blog(Model):
 	user_image=StringField(ddl='varchar(500)')
 	name=StringField(ddl='varchar(50)')
 	summary=StringField(ddl='varchar(200)')
-	content=TextField()
+	#正文很大，列表页不需要，findAll默认不查询，需要时用load/loadColumns加载
+	content=TextField(lazy=True)
+	#保存时渲染好的html，content_hash和renderer_version用来判断是否需要重新渲染
+	html_content=TextField(default='',lazy=True)
+	content_hash=StringField(default='',ddl='varchar(40)')
+	renderer_version=IntegerField()
 	created_at=FloatField(default=time.time)
 
 class Comment(Model):
 	"""docstring for Comment"""
 	__table__='comments'
+	__coalesce__=True
 
 	id=StringField(primary_key=True,default=next_id,ddl='varchar(50)')
 	blog_id=StringField(ddl='varchar(50)')
@@ -3,18 +3,32 @@
 
 __author__='Wby'
 
-import asyncio,logging
+import asyncio,logging,json,base64,re,time,contextvars
 logging.basicConfig(level=logging.INFO)
 
 import aiomysql  #MySql异步IO驱动
 
+from collections import OrderedDict
+
+from cache import LRUCache
+import metrics
+from metrics import Histogram
+
 def log(sql,args=()):
 	logging.info('SQL:%s'%sql)
 
+#MySQL协议的CLIENT_FOUND_ROWS标志(pymysql.constants.CLIENT.FOUND_ROWS)
+_CLIENT_FOUND_ROWS=2
+
 #创建数据库连接池
+#upsert/insertIgnore按影响的行数区分插入、更新和没有变化，连接不能带CLIENT_FOUND_ROWS标志(PyMySQL默认不带)，
+#带了的话update返回的是匹配的行数，没有变化的行也算1行，和插入分不出来
 @asyncio.coroutine
 def create_pool(loop,**kw):
 	logging.info('create database connection pool...')
+	client_flag=kw.get('client_flag',0)
+	if client_flag&_CLIENT_FOUND_ROWS:
+		raise ValueError('client_flag must not include CLIENT.FOUND_ROWS, upsert and insertIgnore rely on affected rows')
 	#全局变量__pool
 	global __pool
 	#创建数据库连接池
@@ -28,33 +42,286 @@ def create_pool(loop,**kw):
 		autocommit=kw.get('autocommit',True),
 		maxsize=kw.get('maxsize',10),
 		minsize=kw.get('minsize',1),
+		client_flag=client_flag,
 		loop=loop
 		)
+	_count_cache.ttl=kw.get('count_cache_ttl',_count_cache.ttl)
+	global _slow_query_time
+	_slow_query_time=kw.get('slow_query_time',_slow_query_time)
+
+#超过这个时间(秒)的语句会写入慢查询日志
+_slow_query_time=0.5
+_slow_log=logging.getLogger('orm.slow')
+
+#每条归一化后的语句的统计信息
+class StatementStats(object):
+	"""docstring for StatementStats"""
+	def __init__(self):
+		self.count=0
+		self.errors=0
+		self.rows=0
+		#和正在执行的相同查询合并、没有实际执行的次数
+		self.coalesced=0
+		#执行耗时和等待连接池的耗时
+		self.time=Histogram()
+		self.wait=Histogram()
+
+	def snapshot(self):
+		return dict(count=self.count,errors=self.errors,rows=self.rows,coalesced=self.coalesced,time=self.time.snapshot(),wait=self.wait.snapshot())
+
+#归一化语句->StatementStats，最多保存这么多条语句，很久没执行的语句的统计会被丢掉
+_statement_stats=LRUCache(1024)
+
+_RE_SPACES=re.compile(r'\s+')
+_RE_IN_LIST=re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)')
+
+#归一化语句：合并空白，in (?,?,...)这种参数个数不同的写成同一种形式
+def normalize_sql(sql):
+	return _RE_IN_LIST.sub('(?...)',_RE_SPACES.sub(' ',sql).strip())
+
+#缓存好的语句(见Model.selectSql)：字符串本身是带?占位符的SQL，日志和统计都用它
+#driver是把?替换成%s之后可以直接交给驱动的SQL，normalized是统计用的归一化语句，每次执行不用再处理
+class Statement(str):
+	"""docstring for Statement"""
+	def __new__(cls,sql,**kw):
+		st=str.__new__(cls,sql)
+		st.driver=sql.replace('?','%s')
+		st.normalized=normalize_sql(sql)
+		st.__dict__.update(kw)
+		return st
+
+#交给驱动执行的SQL
+def _driver_sql(sql):
+	return sql.driver if isinstance(sql,Statement) else sql.replace('?','%s')
+
+#统计和慢查询日志用的归一化语句
+def _normalized(sql):
+	return sql.normalized if isinstance(sql,Statement) else normalize_sql(sql)
+
+def _stats_of(sql):
+	key=_normalized(sql)
+	st=_statement_stats.get(key,None,False)
+	if st is None:
+		st=StatementStats()
+		_statement_stats.set(key,st)
+	return st
+
+#记录一次语句执行，wait是等待连接的时间，elapsed是执行时间，rows是返回或影响的行数
+def _record(sql,args,wait,elapsed,rows,error=False):
+	st=_stats_of(sql)
+	st.count+=1
+	st.rows+=rows
+	st.time.observe(elapsed)
+	st.wait.observe(wait)
+	if error:
+		st.errors+=1
+	#参数里有密码的hash、email等，慢查询日志只记录归一化语句和参数个数
+	if elapsed+wait>=_slow_query_time:
+		nargs=args if isinstance(args,str) else '%s args'%len(args or ())
+		_slow_log.warning('slow query:%.3fs (wait %.3fs) rows:%s SQL:%s (%s)'%(elapsed,wait,rows,_normalized(sql),nargs))
+
+#各语句的统计信息，{归一化语句:{count,errors,rows,time,wait}}，time和wait是直方图快照
+#metrics接口通过这个函数读取
+def query_stats():
+	return dict((k,v.snapshot()) for k,v in _statement_stats.items())
+
+def reset_query_stats():
+	_statement_stats.clear()
+
+#findAll/findNumber等用到的查询形状，(表名,where,orderBy)->次数，advisor.py根据它检查索引
+#和语句统计一样最多保存1024种
+_query_shapes=LRUCache(1024)
+
+def _shape_key(table,where,orderBy):
+	return (table,normalize_sql(where) if where else None,normalize_sql(orderBy) if orderBy else None)
+
+def _record_shape(key):
+	_query_shapes.set(key,_query_shapes.get(key,0,False)+1)
+
+#[{table,where,order_by,count},...]，按次数从多到少排列
+def query_shapes():
+	return [dict(table=t,where=w,order_by=o,count=n) for (t,w,o),n in sorted(_query_shapes.items(),key=lambda x:-x[1])]
+
+#不小于n的2的幂，最大为limit
+def _padded_size(n,limit):
+	size=1
+	while size<n:
+		size*=2
+	return min(size,limit)
+
+#语句缓存，(Model子类,查询种类,查询形状...)->Statement
+#同一种查询(where、orderBy、limit的形式、查询的列都相同)只拼一次SQL、替换一次占位符
+#aiomysql(PyMySQL)不支持服务端的prepared statement，这里缓存的是最终交给驱动的SQL文本
+_statement_cache=LRUCache(1024)
+
+def statement_cache_stats():
+	return _statement_cache.stats()
+
+#给/metrics提供连接池和各语句的指标
+def _collect_metrics():
+	ps=pool_stats()
+	time_samples=[]
+	wait_samples=[]
+	for sql,st in _statement_stats.items():
+		labels=dict(statement=sql)
+		time_samples.extend(metrics.histogram_samples(labels,st.time))
+		wait_samples.extend(metrics.histogram_samples(labels,st.wait))
+	return [
+		('db_pool_size','gauge','Connections opened by the pool.',[('',{},ps['size'])]),
+		('db_pool_free','gauge','Idle connections in the pool.',[('',{},ps['free'])]),
+		('db_pool_maxsize','gauge','Pool size limit.',[('',{},ps['maxsize'])]),
+		('db_pool_waiting','gauge','Coroutines waiting for a connection.',[('',{},ps['waiting'])]),
+		('db_statement_duration_seconds','histogram','SQL statement execution time.',time_samples),
+		('db_statement_pool_wait_seconds','histogram','Time waiting for a pool connection.',wait_samples),
+		('db_statement_errors_total','counter','Failed SQL statements.',[('',dict(statement=k),st.errors) for k,st in _statement_stats.items()]),
+		('db_statement_rows_total','counter','Rows returned or affected.',[('',dict(statement=k),st.rows) for k,st in _statement_stats.items()]),
+		('db_statement_coalesced_total','counter','Selects served by an identical in-flight query.',[('',dict(statement=k),st.coalesced) for k,st in _statement_stats.items()]),
+		('db_inflight_selects','gauge','Shared select queries in flight.',[('',{},len(_inflight))]),
+		('db_identity_map_hits_total','counter','Primary key lookups served by the request identity map.',[('',{},_identity_hits)])
+	]
+
+metrics.register_collector(_collect_metrics)
+metrics.register_collector(metrics.cache_collector('statement',_statement_cache))
+
+#关闭连接池，等待所有连接关闭
+@asyncio.coroutine
+def close_pool():
+	global __pool
+	pool=globals().get('__pool')
+	if pool is not None:
+		__pool=None
+		pool.close()
+		yield from pool.wait_closed()
+
+#正在等待连接池的协程数
+_pool_waiting=0
+
+#从连接池取一个连接，返回(连接的上下文管理器,等待的时间)，用法：
+#	cm,wait=yield from _acquire()
+#	with cm as conn:
+@asyncio.coroutine
+def _acquire():
+	global _pool_waiting
+	start=time.time()
+	_pool_waiting+=1
+	try:
+		cm=yield from __pool
+	finally:
+		_pool_waiting-=1
+	return cm,time.time()-start
+
+#连接池的状态
+def pool_stats():
+	pool=globals().get('__pool')
+	if pool is None:
+		return dict(size=0,free=0,maxsize=0,waiting=_pool_waiting)
+	return dict(size=pool.size,free=pool.freesize,maxsize=pool.maxsize,waiting=_pool_waiting)
+
 #查询函数，该函数是协程
+#coalesce为True时，和正在执行的相同查询(sql,args,size都相同)共用一个结果，不再占用一个连接
+#tuples为True时每行返回tuple而不是dict，少构造一个dict
 @asyncio.coroutine
-def select(sql,args,size=None):
+def select(sql,args,size=None,coalesce=False,tuples=False):
+	#在事务里的查询用事务的连接，能读到事务里还没提交的修改
+	tx=_transaction.get()
+	if tx is not None:
+		return (yield from tx.select(sql,args,size,tuples))
+	if coalesce:
+		return (yield from _shared_select(sql,args,size,tuples))
 	log(sql,args) #调用log函数写日志
-	global __pool
 	#从连接池取出一个conn处理，with...as...会在运行完后把conn放回连接池
-	with (yield from __pool) as conn:
-		#获取一个cursor，通过aiomysql.DictCursor获取到的cursor在返回结果时会返回一个字典格式
-		cur=yield from conn.cursor(aiomysql.DictCursor)
-		#将SQL语句的占位符?替换为MySql的占位符%s，并执行SQL
-		yield from cur.execute(sql.replace('?','%s'),args or ()) 
-		if size:
-			rs=yield from cur.fetchmany(size)
-		else:
-			rs=yield from cur.fetchall()
-		yield from cur.close()  #关闭cursor
+	cm,wait=yield from _acquire()
+	with cm as conn:
+		acquired=time.time()
+		try:
+			#获取一个cursor，通过aiomysql.DictCursor获取到的cursor在返回结果时会返回一个字典格式
+			cur=yield from conn.cursor(aiomysql.Cursor if tuples else aiomysql.DictCursor)
+			#将SQL语句的占位符?替换为MySql的占位符%s，并执行SQL
+			yield from cur.execute(_driver_sql(sql),args or ()) 
+			if size:
+				rs=yield from cur.fetchmany(size)
+			else:
+				rs=yield from cur.fetchall()
+			yield from cur.close()  #关闭cursor
+		except BaseException as e:
+			_record(sql,args,wait,time.time()-acquired,0,True)
+			raise
+		_record(sql,args,wait,time.time()-acquired,len(rs))
 		logging.info('rows returned:%s'%len(rs))
 		return rs
+
+#正在执行的可合并查询，(sql,args,size,tuples)->Task
+_inflight={}
+
+#单飞查询：相同的查询同时只执行一次，后来的请求等待同一个结果
+#查询放在单独的Task里执行，某个等待者被取消不会影响其他等待者
+#每次写操作后清空_inflight，写操作之后开始的查询不会拿到写之前的结果
+@asyncio.coroutine
+def _shared_select(sql,args,size,tuples=False):
+	try:
+		key=(sql,tuple(args or ()),size,tuples)
+		task=_inflight.get(key)
+	except TypeError:
+		#参数不能作为key的，直接查询
+		return (yield from select(sql,args,size,tuples=tuples))
+	if task is None:
+		task=_inflight[key]=asyncio.ensure_future(select(sql,args,size,tuples=tuples))
+		task.add_done_callback(lambda t:_shared_done(key,t))
+	else:
+		_stats_of(sql).coalesced+=1
+	rs=yield from asyncio.shield(task)
+	#每个调用者拿到自己的list
+	return list(rs)
+
+def _shared_done(key,task):
+	if _inflight.get(key) is task:
+		del _inflight[key]
+	#所有等待者都被取消时，避免出现Task exception was never retrieved
+	if not task.cancelled():
+		task.exception()
+
+#流式查询，用服务端游标(SSDictCursor)每次读取size行，内存里最多只有一批数据
+#这是一个异步生成器，用async for遍历
+async def iter_select(sql,args,size=100):
+	log(sql,args)
+	conn,wait=await _acquire_conn()
+	finished=False
+	rows=0
+	#只统计执行和读取的时间，不包括消费者处理每一批的时间
+	elapsed=0.0
+	try:
+		start=time.time()
+		cur=await conn.cursor(aiomysql.SSDictCursor)
+		await cur.execute(_driver_sql(sql),args or ())
+		while True:
+			rs=await cur.fetchmany(size)
+			elapsed+=time.time()-start
+			if not rs:
+				break
+			rows+=len(rs)
+			yield rs
+			start=time.time()
+		await cur.close()
+		finished=True
+	finally:
+		_record(sql,args,wait,elapsed,rows)
+		#消费者提前退出时结果集还没读完，这个连接不能再用了，关掉它，连接池会丢弃关闭的连接
+		if not finished:
+			conn.close()
+		_release_conn(conn)
+
 #用于执行insert,update,delete语句
 @asyncio.coroutine
 def execute(sql,args,autocommit=True):
 	#yield from print('SQL:',sql,'Args:',args)
+	tx=_transaction.get()
+	if tx is not None:
+		return (yield from tx.execute(sql,args))
 	log(sql)
 	#async with __pool.get() as conn:
-	with (yield from __pool) as conn:
+	cm,wait=yield from _acquire()
+	with cm as conn:
+		acquired=time.time()
 		if not autocommit:
 			#await conn.begin()
 			yield from conn.begin()
@@ -62,7 +329,7 @@ def execute(sql,args,autocommit=True):
 			#async with conn.cursor(aiomysql.DictCursor) as cur:
 			cur=yield from conn.cursor()
 			#await cur.execute(sql.replace('?','%s'),args)
-			yield from cur.execute(sql.replace('?','%s'),args)
+			yield from cur.execute(_driver_sql(sql),args)
 			affected=cur.rowcount
 			yield from cur.close()
 			if not autocommit:
@@ -72,9 +339,371 @@ def execute(sql,args,autocommit=True):
 			if not autocommit:
 				#await conn.rollback()
 				yield from conn.rollback()
+			_record(sql,args,wait,time.time()-acquired,0,True)
 			raise
+		_record(sql,args,wait,time.time()-acquired,affected)
+		_inflight.clear()
 		return affected
 
+#批量执行同一条insert/update语句，所有批次在同一个事务里，返回每一批影响的行数
+#seq_args:每一行的参数列表
+#size:每批的行数，insert语句会被aiomysql合并成一条多行insert
+@asyncio.coroutine
+def executemany(sql,seq_args,size=500):
+	tx=_transaction.get()
+	if tx is not None:
+		return (yield from tx.executemany(sql,seq_args,size))
+	log(sql)
+	cm,wait=yield from _acquire()
+	with cm as conn:
+		acquired=time.time()
+		yield from conn.begin()
+		try:
+			cur=yield from conn.cursor()
+			driver=_driver_sql(sql)
+			counts=[]
+			for i in range(0,len(seq_args),size):
+				yield from cur.executemany(driver,seq_args[i:i+size])
+				counts.append(cur.rowcount)
+			yield from cur.close()
+			yield from conn.commit()
+		except BaseException as e:
+			yield from conn.rollback()
+			_record(sql,'%s rows'%len(seq_args),wait,time.time()-acquired,0,True)
+			raise
+		_record(sql,'%s rows'%len(seq_args),wait,time.time()-acquired,sum(counts))
+		_inflight.clear()
+		return counts
+
+#从连接池取一个连接，返回(连接,等待的时间)，用完要调用_release_conn
+@asyncio.coroutine
+def _acquire_conn():
+	global _pool_waiting
+	start=time.time()
+	_pool_waiting+=1
+	try:
+		conn=yield from __pool.acquire()
+	finally:
+		_pool_waiting-=1
+	return conn,time.time()-start
+
+#aiomysql释放已经关闭的连接时不会唤醒等待连接的协程，这里补上，让它们可以新建一个连接
+def _release_conn(conn):
+	closed=conn.closed
+	__pool.release(conn)
+	if closed:
+		asyncio.ensure_future(__pool._wakeup())
+
+#upsert影响的行数对应的结果
+_UPSERT_RESULTS={0:'unchanged',1:'inserted',2:'updated'}
+
+#当前的事务，由transaction()设置
+_transaction=contextvars.ContextVar('transaction',default=None)
+
+#事务，用法：
+#	async with orm.transaction():
+#		await blog.remove()
+#		...
+#事务里的select/execute都用同一个连接，最后只提交一次，出现异常则回滚
+#Model的save/update/remove先放进队列，在提交前、事务里执行查询前或队列满了时一起执行，
+#连续的相同语句(比如一组insert或delete)合并成一次executemany
+#PyMySQL只把insert/replace的executemany合并成一条多行语句，其他语句还是每行一次往返，批量删除用Model.removeAll
+#事务里find/findMany/findAll不使用identity map，见_identity_map
+#这些写操作返回None，条目数缓存的调整和add_listener注册的回调在提交成功后才执行
+#嵌套的transaction()加入外层的事务
+class Transaction(object):
+	"""docstring for Transaction"""
+	#队列里最多保存的写操作，超过就先执行
+	MAX_QUEUE=1000
+
+	def __init__(self):
+		self.conn=None
+		self.outer=None
+		#[(sql,args,回调),...]，回调在提交后以影响的行数为参数调用
+		self.queue=[]
+		#已经执行、等待提交后调用的[(回调,行数),...]
+		self.done=[]
+		#同一个事务里的协程(比如gather)不能同时使用这个连接
+		self.lock=asyncio.Lock()
+
+	async def __aenter__(self):
+		self.outer=_transaction.get()
+		if self.outer is not None:
+			return self.outer
+		self.conn,wait=await _acquire_conn()
+		try:
+			await self.conn.begin()
+		except BaseException:
+			self.conn.close()
+			_release_conn(self.conn)
+			raise
+		self.token=_transaction.set(self)
+		return self
+
+	async def __aexit__(self,exc_type,exc,tb):
+		if self.outer is not None:
+			return False
+		_transaction.reset(self.token)
+		try:
+			if exc_type is None:
+				try:
+					async with self.lock:
+						await self._flush()
+						await self.conn.commit()
+				except BaseException:
+					#回滚也失败的话记一下日志，抛出的还是提交时的异常
+					try:
+						await self._rollback()
+					except BaseException:
+						logging.exception('rollback failed')
+					raise
+				for fn,rows in self.done:
+					fn(rows)
+				_inflight.clear()
+			else:
+				await self._rollback()
+		finally:
+			_release_conn(self.conn)
+			self.conn=None
+		return False
+
+	async def _rollback(self):
+		self.queue=[]
+		self.done=[]
+		try:
+			await self.conn.rollback()
+		except BaseException:
+			#回滚失败的连接不能再用了
+			self.conn.close()
+			raise
+
+	#放进队列的写操作，done(rows)在提交后调用
+	async def write(self,sql,args,done=None):
+		self.queue.append((sql,args,done))
+		if len(self.queue)>=self.MAX_QUEUE:
+			async with self.lock:
+				await self._flush()
+
+	#执行队列里的写操作，连续的相同语句用一次executemany执行
+	async def _flush(self):
+		queue,self.queue=self.queue,[]
+		i=0
+		while i<len(queue):
+			sql=queue[i][0]
+			j=i+1
+			while j<len(queue) and queue[j][0]==sql:
+				j+=1
+			group=queue[i:j]
+			log(sql)
+			start=time.time()
+			try:
+				cur=await self.conn.cursor()
+				if len(group)==1:
+					await cur.execute(_driver_sql(sql),group[0][1])
+					rows=[cur.rowcount]
+				else:
+					await cur.executemany(_driver_sql(sql),[args for s,args,fn in group])
+					#executemany只返回总行数，对不上的话每一行都不知道影响了几行
+					rows=[1]*len(group) if cur.rowcount==len(group) else [None]*len(group)
+				await cur.close()
+			except BaseException:
+				_record(sql,'%s rows'%len(group),0,time.time()-start,0,True)
+				raise
+			_record(sql,'%s rows'%len(group),0,time.time()-start,sum(n or 0 for n in rows))
+			self.done.extend((fn,n) for (s,args,fn),n in zip(group,rows) if fn is not None)
+			i=j
+
+	async def select(self,sql,args,size=None,tuples=False):
+		async with self.lock:
+			await self._flush()
+			log(sql,args)
+			start=time.time()
+			try:
+				cur=await self.conn.cursor(aiomysql.Cursor if tuples else aiomysql.DictCursor)
+				await cur.execute(_driver_sql(sql),args or ())
+				rs=await (cur.fetchmany(size) if size else cur.fetchall())
+				await cur.close()
+			except BaseException:
+				_record(sql,args,0,time.time()-start,0,True)
+				raise
+			_record(sql,args,0,time.time()-start,len(rs))
+			return rs
+
+	#直接执行，先执行队列里的写操作，保证顺序
+	async def execute(self,sql,args):
+		async with self.lock:
+			await self._flush()
+			log(sql)
+			start=time.time()
+			try:
+				cur=await self.conn.cursor()
+				await cur.execute(_driver_sql(sql),args)
+				affected=cur.rowcount
+				await cur.close()
+			except BaseException:
+				_record(sql,args,0,time.time()-start,0,True)
+				raise
+			_record(sql,args,0,time.time()-start,affected)
+			return affected
+
+	async def executemany(self,sql,seq_args,size=500):
+		async with self.lock:
+			await self._flush()
+			log(sql)
+			start=time.time()
+			counts=[]
+			try:
+				cur=await self.conn.cursor()
+				for i in range(0,len(seq_args),size):
+					await cur.executemany(_driver_sql(sql),seq_args[i:i+size])
+					counts.append(cur.rowcount)
+				await cur.close()
+			except BaseException:
+				_record(sql,'%s rows'%len(seq_args),0,time.time()-start,0,True)
+				raise
+			_record(sql,'%s rows'%len(seq_args),0,time.time()-start,sum(counts))
+			return counts
+
+def transaction():
+	return Transaction()
+
+#在一个事务里执行协程函数fn(*args,**kw)，返回它的结果，给不能用async with的@asyncio.coroutine函数用
+@asyncio.coroutine
+def in_transaction(fn,*args,**kw):
+	async def run():
+		async with transaction():
+			return await fn(*args,**kw)
+	return (yield from run())
+
+#Model的写操作，不在事务里时马上执行并调用done(rows)，在事务里时放进事务的队列
+#queue为False时在事务里也马上执行并返回影响的行数，done还是在提交后调用
+@asyncio.coroutine
+def _write(sql,args,done,queue=True):
+	tx=_transaction.get()
+	if tx is not None:
+		if not queue:
+			rows=yield from tx.execute(sql,args)
+			tx.done.append((done,rows))
+			return rows
+		yield from tx.write(sql,args,done)
+		return None
+	rows=yield from execute(sql,args)
+	done(rows)
+	return rows
+
+#游标分页的token，把上一页最后一条记录的(created_at,主键)编码成一个不透明的字符串
+def encode_cursor(created_at,pk):
+	s=json.dumps([created_at,pk],separators=(',',':'))
+	return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+#解析游标分页的token，格式不对则抛ValueError
+def decode_cursor(token):
+	try:
+		s=base64.urlsafe_b64decode(token+'='*(-len(token)%4))
+		created_at,pk=json.loads(s.decode('utf-8'))
+		return float(created_at),str(pk)
+	except (ValueError,TypeError) as e:
+		raise ValueError('Invalid cursor:%s'%token)
+
+#count查询结果的缓存，key为(表名,where,args)
+_count_cache=LRUCache(1024,60)
+#估算的行数小于这个值时仍然用count查询，小表的统计信息误差大，count也很快
+_ESTIMATE_MIN=10000
+
+#表的行数变化时调整count缓存：不带条件的总数直接加减delta，带条件的全部作废，估算值保留到过期
+#delta为None表示不知道变化了多少，全部作废
+def _count_changed(table,delta):
+	total=(table,None,())
+	n=_count_cache.get(total,count=False)
+	_count_cache.remove_if(lambda k,v:k[0]==table and (delta is None or (k!=total and k[1]!='__estimate__')))
+	#只修改值不延长有效时间，经常写的进程也会按时从数据库重新读取总数，各进程的值不会一直偏离
+	if n is not None and delta:
+		_count_cache.replace(total,n+delta)
+
+#count缓存的命中统计
+def count_cache_stats():
+	return _count_cache.stats()
+
+metrics.register_collector(metrics.cache_collector('count',_count_cache))
+
+#数据变更监听器，{Model子类:[fn,...]}
+#save/update/remove执行后会调用fn(action,obj)，action为'save','update'或'remove'
+#removeAll按条件删除时，对删除的每个对象调用fn('remove',obj)
+_listeners={}
+
+def add_listener(model,fn):
+	_listeners.setdefault(model,[]).append(fn)
+
+def _notify(action,obj):
+	for fn in _listeners.get(type(obj),()):
+		fn(action,obj)
+	imap=identity_map.get()
+	if imap is not None:
+		pk=obj.getValue(obj.__primary_key__)
+		if action=='remove':
+			imap.put(type(obj),pk,None)
+		elif action=='save':
+			#insert写入的是每一列getValueOrDefault的值，id、created_at等默认值是用setattr设置的，不在dict里
+			imap.put(type(obj),pk,dict((f,obj.getValueOrDefault(f)) for f in obj.__mappings__))
+		else:
+			imap.put(type(obj),pk,obj)
+
+#请求范围的identity map，一个请求里按主键加载过的对象不再查数据库
+#保存的是行数据的副本，find返回的也是副本，修改返回的对象不会影响map里的数据
+class IdentityMap(object):
+	"""docstring for IdentityMap"""
+	def __init__(self, debug=False):
+		#(表名,主键)->行dict，None表示数据库里没有这条记录
+		self._rows={}
+		#debug为True时记录每次省掉的查询
+		self.debug=debug
+		self.hits=0
+
+	#返回(是否命中,行dict或None)
+	def get(self,cls,pk):
+		key=(cls.__table__,pk)
+		if key not in self._rows:
+			return False,None
+		self.hits+=1
+		global _identity_hits
+		_identity_hits+=1
+		if self.debug:
+			logging.info('identity map hit:%s(%s), query avoided'%(cls.__name__,pk))
+		row=self._rows[key]
+		return True,None if row is None else dict(row)
+
+	#row是Model对象时，只保存所有列都加载了的对象，只加载了部分列的对象会删掉map里原有的记录
+	def put(self,cls,pk,row):
+		key=(cls.__table__,pk)
+		if isinstance(row,Model):
+			row=row.loadedValues()
+			if len(row)<len(cls.__mappings__):
+				self._rows.pop(key,None)
+				return
+		self._rows[key]=None if row is None else dict(row)
+
+	#删除一条记录，不知道数据库里现在的值时用
+	def discard(self,cls,pk):
+		self._rows.pop((cls.__table__,pk),None)
+
+	#删除cls这个表的所有记录，按条件批量修改之后用
+	def drop(self,cls):
+		for key in [k for k in self._rows if k[0]==cls.__table__]:
+			del self._rows[key]
+
+	def __len__(self):
+		return len(self._rows)
+
+#当前请求的IdentityMap，由app.py的identity_map_factory中间件设置，没有请求时为None
+identity_map=contextvars.ContextVar('identity_map',default=None)
+
+#查询用的identity map，在事务里时返回None
+#事务里的写操作提交后才更新identity map，读到的可能是修改前的记录；事务里读到的记录也可能被回滚
+def _identity_map():
+	return identity_map.get() if _transaction.get() is None else None
+#所有请求省掉的查询数
+_identity_hits=0
+
 #构造sql语句参数字符串，最后返回的字符串会以‘,’分割多个'?'，如num==2,则会返回'?,?'
 def create_args_string(num):
 	L=[]
@@ -89,6 +718,9 @@ def create_args_string(num):
 #default:默认值
 class Field(object):
 	"""用于标识model里每个成员变量的类"""
+	#为True时findAll默认不查询这一列，需要时用load/loadColumns加载
+	lazy=False
+
 	#init函数，在对象new之后初始化时自动调用，这里初始化一些成员变量
 	def __init__(self, name,column_type,primary_key,default):
 		self.name=name
@@ -126,8 +758,53 @@ class FloatField(Field):
 #text类型的默认设定
 class TextField(Field):
 	"""docstring for TextField"""
-	def __init__(self, name=None,default=None):
+	def __init__(self, name=None,default=None,lazy=False):
 		super().__init__(name,'text',False,default)
+		self.lazy=lazy
+
+#轻量的行对象，findAll(...,compact=True)返回，每个Model子类由元类生成一个<类名>Record
+#不能save/update，要修改的话先用to_model()转换成Model对象
+#用__slots__保存各列，比dict子类的Model省内存，属性访问也不需要走__getattr__和捕获KeyError
+#直接由tuple游标返回的行构造：Record(*row)，列的顺序和__select__一样(主键在最前面)
+class Record(object):
+	"""docstring for Record"""
+	__slots__=()
+	#对应的Model子类
+	__model__=None
+
+	def __getitem__(self,key):
+		try:
+			return getattr(self,key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def get(self,key,default=None):
+		return getattr(self,key,default)
+
+	def keys(self):
+		return self.__slots__
+
+	#json编码用，见jsonenc
+	def __json__(self):
+		return dict((k,getattr(self,k)) for k in self.__slots__)
+
+	#转换成完整的Model对象，用于修改后save/update
+	def to_model(self):
+		return self.__model__(**self.__json__())
+
+	def __repr__(self):
+		return '%s(%s)'%(type(self).__name__,', '.join('%s=%r'%(k,getattr(self,k)) for k in self.__slots__))
+
+#(Model子类,列名tuple)->只包含这些列的Record类，见Model.recordClass
+_record_classes={}
+
+#生成一个Record子类，columns是列名(属性名)的顺序
+#__init__按列生成代码(和collections.namedtuple一样)，比循环setattr快好几倍
+def make_record_class(name,columns):
+	src='def __init__(self,%s):\n%s'%(','.join(columns),''.join('\tself.%s=%s\n'%(c,c) for c in columns))
+	ns={}
+	exec(src,ns)
+	return type(name,(Record,),dict(__slots__=tuple(columns),__init__=ns['__init__']))
 
 #model元类，元类可以创建类对象，可以查看这个http://blog.jobbole.com/21351/,了解元类
 class ModelMetaclass(type):
@@ -173,25 +850,46 @@ class ModelMetaclass(type):
 		attrs['__table__']=tableName			#表名
 		attrs['__primary_key__']=primaryKey 	#主键属性名
 		attrs['__fields__']=fields 				#除主键外的属性名
+		attrs['__lazy__']=[f for f in fields if mappings[f].lazy]		#延迟加载的属性名
+		attrs['__eager__']=[primaryKey]+[f for f in fields if not mappings[f].lazy]	#findAll默认查询的属性名
 		#构造默认的SELECT,INSERT,UPDATE和DELETE语句
 		attrs['__select__']='select `%s`,%s from `%s`'%(primaryKey,', '.join(escaped_fields),tableName)
-		attrs['__insert__']='insert into `%s` (%s,`%s`) values (%s)'%(tableName,', '.join(escaped_fields),primaryKey,create_args_string(len(escaped_fields)+1))
-		attrs['__update__']='update `%s` set %s where `%s`=?'%(tableName,', '.join(map(lambda f:'`%s`=?'%(mappings.get(f).name or f),fields)),primaryKey)
-		attrs['__delete__']='delete from `%s` where `%s`=?'%(tableName,primaryKey)
+		#固定的语句直接构造成Statement，执行时不用再替换占位符
+		attrs['__find__']=Statement('%s where `%s`=?'%(attrs['__select__'],primaryKey))
+		attrs['__insert__']=Statement('insert into `%s` (%s,`%s`) values (%s)'%(tableName,', '.join(escaped_fields),primaryKey,create_args_string(len(escaped_fields)+1)))
+		attrs['__update__']=Statement('update `%s` set %s where `%s`=?'%(tableName,', '.join(map(lambda f:'`%s`=?'%(mappings.get(f).name or f),fields)),primaryKey))
+		attrs['__delete__']=Statement('delete from `%s` where `%s`=?'%(tableName,primaryKey))
+		#主键或唯一索引冲突时更新所有列/什么都不做，见upsert和insertIgnore
+		attrs['__upsert__']=Statement('%s on duplicate key update %s'%(attrs['__insert__'],', '.join(map(lambda f:'`%s`=values(`%s`)'%(f,f),fields))))
+		attrs['__insert_ignore__']=Statement('%s on duplicate key update `%s`=`%s`'%(attrs['__insert__'],primaryKey,primaryKey))
 		#构造类
-		return type.__new__(cls,name,bases,attrs)
+		model=type.__new__(cls,name,bases,attrs)
+		#紧凑的只读行对象，见Record
+		model.__record__=make_record_class(name+'Record',[primaryKey]+fields)
+		model.__record__.__model__=model
+		return model
 
 #Model类，元类是ModelMetalclass
 class Model(dict,metaclass=ModelMetaclass):
 	"""ORM映射的基类Model"""
+	#为True时find/findAll/findNumber默认合并同时进行的相同查询，见select
+	__coalesce__=False
+
 	def __init__(self, **kw):
 		super(Model, self).__init__(**kw)
 
+	#coalesce参数为None时用类的默认设置
+	@classmethod
+	def _coalesce(cls,coalesce):
+		return cls.__coalesce__ if coalesce is None else coalesce
+
 	#重写访问属性的方法，没有属性和Key一样抛错
 	def __getattr__(self,key):
 		try:
 			return self[key]
 		except KeyError:
+			if key in self.__lazy__:
+				raise AttributeError(r"'%s' column '%s' is not loaded, use load() or loadColumns()"%(self.__class__.__name__,key))
 			raise AttributeError(r"'Model' object has no attribute '%s'"%key)
 
 	#重写写属性的方法
@@ -200,6 +898,24 @@ class Model(dict,metaclass=ModelMetaclass):
 
 	def getValue(self,key):
 		return getattr(self,key,None)
+
+	#已经加载或设置过的列，{属性名:值}，包括用setattr设置的值
+	def loadedValues(self):
+		d=self.__dict__
+		return dict((k,d[k] if k in d else self[k]) for k in self.__mappings__ if k in d or k in self)
+
+	#findAll要查询的列，总是包括主键，columns为None时是除了lazy列以外的所有列
+	@classmethod
+	def selectColumns(cls,columns=None):
+		if columns is None:
+			return cls.__eager__
+		cols=[cls.__primary_key__]
+		for c in columns:
+			if c not in cls.__mappings__:
+				raise ValueError('Invalid column:%s'%c)
+			if c not in cols:
+				cols.append(c)
+		return cols
 	
 	#访问某个key的方法，如果value是None，则去mappings获取default的值
 	def getValueOrDefault(self,key):
@@ -212,82 +928,383 @@ class Model(dict,metaclass=ModelMetaclass):
 				setattr(self,key,value)
 		return value
 
-	#查询所有，可以设定查询顺序'order by',查询条件'limit'
+	#构造findAll和findIter的select语句，返回(sql,args)
+	#可以设定查询顺序'orderBy',查询条件'limit'，只查询某些列'columns'(见selectColumns)
+	#传入cursor参数时使用游标分页：按(created_at,主键)倒序，从cursor对应的记录之后开始取，
+	#可以直接用idx_created_at定位，不需要像limit offset,n那样扫描前面的offset条
+	#cursor为None或''表示从第一条开始
+	#返回的sql是缓存的Statement，columns属性是查询的列
 	@classmethod
-	@asyncio.coroutine
-	def findAll(cls,where=None,args=None,**kw):
-		'find objects by where clause.'
-		sql=[cls.__select__]
+	def selectSql(cls,where=None,args=None,**kw):
+		args=[] if args is None else list(args)
+		orderBy=kw.get('orderBy') or kw.get('order by')
+		seek=False
+		if 'cursor' in kw:
+			orderBy='`created_at` desc, `%s` desc'%cls.__primary_key__
+			if kw['cursor']:
+				created_at,pk=decode_cursor(kw['cursor'])
+				args.extend([created_at,created_at,pk])
+				seek=True
+		limit=kw.get('limit',None)
+		if limit is None:
+			nlimit=0
+		elif isinstance(limit,int):
+			nlimit=1
+			args.append(limit)
+		elif isinstance(limit,tuple) and len(limit)==2:
+			nlimit=2
+			args.extend(limit)
+		else:
+			raise ValueError('Invalid limit value:%s'%str(limit))
+		columns=kw.get('columns')
+		if columns is not None:
+			columns=tuple(columns)
+		key=(cls,'select',where,orderBy,seek,nlimit,columns)
+		sql=_statement_cache.get(key)
+		if sql is None:
+			sql=cls._buildSelect(where,orderBy,seek,nlimit,columns)
+			_statement_cache.set(key,sql)
+		_record_shape(sql.shape)
+		return sql,args
+
+	#拼selectSql的语句，seek为True时加上游标分页的条件，nlimit是limit参数的个数
+	@classmethod
+	def _buildSelect(cls,where,orderBy,seek,nlimit,columns):
+		if seek:
+			seek='(`created_at`<? or (`created_at`=? and `%s`<?))'%cls.__primary_key__
+			where='(%s) and %s'%(where,seek) if where else seek
+		cols=cls.selectColumns(columns)
+		if len(cols)==len(cls.__mappings__):
+			sql=[cls.__select__]
+		else:
+			sql=['select %s from `%s`'%(', '.join('`%s`'%c for c in cols),cls.__table__)]
 		if where:
 			sql.append('where')
 			sql.append(where)
 
-		if args is None:
-			args=[]
-		orderBy=kw.get('order by')
 		if orderBy:
 			sql.append('order by')
 			sql.append(orderBy)
-		limit=kw.get('limit',None)
-		if limit is not None:
+		if nlimit:
 			sql.append('limit')
-			if  isinstance(limit,int):
-				sql.append('?')
-				args.append(limit)
-			elif isinstance(limit,tuple) and len(limit)==2:
-				sql.append('?,?')
-				args.extend(limit)
-			else:
-				raise ValueError('Invalid limit value:%s'%str(limit))
-		rs=yield from select(' '.join(sql),args)
-		return [cls(**r) for r in rs]
+			sql.append('?' if nlimit==1 else '?,?')
+		return Statement(' '.join(sql),shape=_shape_key(cls.__table__,where,orderBy),columns=cols)
+
+	#查询所有，参数见selectSql
+	#默认不查询lazy列，columns参数指定要查询的列，没有查询的列可以之后用loadColumns一次加载
+	#compact为True时返回Record对象(见Record)，适合只读的大结果集，不放进identity map
+	@classmethod
+	@asyncio.coroutine
+	def findAll(cls,where=None,args=None,**kw):
+		'find objects by where clause.'
+		sql,args=cls.selectSql(where,args,**kw)
+		cols=sql.columns
+		if kw.get('compact'):
+			rs=yield from select(sql,args,coalesce=cls._coalesce(kw.get('coalesce')),tuples=True)
+			record=cls.recordClass(cols)
+			return [record(*r) for r in rs]
+		rs=yield from select(sql,args,coalesce=cls._coalesce(kw.get('coalesce')))
+		objs=[cls(**r) for r in rs]
+		#查到的完整对象放进identity map，之后同一个请求里按主键find不用再查
+		imap=_identity_map()
+		if imap is not None and len(cols)==len(cls.__mappings__):
+			for obj in objs:
+				imap.put(cls,obj.getValue(cls.__primary_key__),obj)
+		return objs
+
+	#只包含columns这些列的Record类，columns为全部列时就是__record__
+	@classmethod
+	def recordClass(cls,columns):
+		if len(columns)==len(cls.__mappings__):
+			return cls.__record__
+		key=(cls,tuple(columns))
+		record=_record_classes.get(key)
+		if record is None:
+			record=_record_classes[key]=make_record_class(cls.__name__+'Record',columns)
+			record.__model__=cls
+		return record
+
+	#给一组对象加载没有查询的列(默认是lazy列)，每batch_size个对象一条where pk in (...)查询
+	@classmethod
+	@asyncio.coroutine
+	def loadColumns(cls,objs,columns=None,batch_size=500):
+		'load deferred columns for a list of objects.'
+		columns=[c for c in (columns or cls.__lazy__) if c!=cls.__primary_key__]
+		byId=OrderedDict()
+		for obj in objs:
+			byId.setdefault(obj.getValue(cls.__primary_key__),[]).append(obj)
+		ids=list(byId)
+		for i in range(0,len(ids),batch_size):
+			batch=ids[i:i+batch_size]
+			sql='select `%s`,%s from `%s` where `%s` in (%s)'%(cls.__primary_key__,', '.join('`%s`'%c for c in columns),cls.__table__,cls.__primary_key__,create_args_string(len(batch)))
+			rs=yield from select(sql,batch)
+			for r in rs:
+				for obj in byId.get(r[cls.__primary_key__],()):
+					for c in columns:
+						obj[c]=r[c]
+		return objs
+
+	#加载这个对象没有查询的列，columns为空时加载所有lazy列
+	@asyncio.coroutine
+	def load(self,*columns):
+		yield from type(self).loadColumns([self],columns or None)
+		return self
+
+	#流式查询，每次产出最多batch_size个对象组成的list，不会把整张表读进内存，参数见selectSql
+	#用法：async for users in User.findIter(): ...
+	#提前退出循环时最好调用aclose()，这样连接会马上还给连接池
+	@classmethod
+	async def findIter(cls,where=None,args=None,batch_size=100,**kw):
+		'iterate objects by where clause in batches.'
+		sql,args=cls.selectSql(where,args,**kw)
+		it=iter_select(sql,args,batch_size)
+		try:
+			async for rs in it:
+				yield [cls(**r) for r in rs]
+		finally:
+			await it.aclose()
 
 	#查询某个条件下的数据有多少条
 	@classmethod
 	@asyncio.coroutine
-	def findNumber(cls,selectField,where=None,args=None):
+	def findNumber(cls,selectField,where=None,args=None,coalesce=None):
 		'find number by select and where'
-		sql=['select %s _num_ from `%s`'%(selectField,cls.__table__)]
-		if where:
-			sql.append('where')
-			sql.append(where)
-		rs=yield from select(' '.join(sql),args,1)
+		key=(cls,'number',selectField,where)
+		sql=_statement_cache.get(key)
+		if sql is None:
+			sql=['select %s _num_ from `%s`'%(selectField,cls.__table__)]
+			if where:
+				sql.append('where')
+				sql.append(where)
+			sql=Statement(' '.join(sql),shape=_shape_key(cls.__table__,where,None))
+			_statement_cache.set(key,sql)
+		_record_shape(sql.shape)
+		rs=yield from select(sql,args,1,cls._coalesce(coalesce))
 		if len(rs)==0:
 			return None
 		return rs[0]['_num_']
 
+	#查询条目数，结果会缓存一段时间，save/remove时会自动调整
+	#estimate为True时从information_schema读取估算的行数(只用于不带条件的总数)，
+	#适合不需要精确总数的管理页面
+	@classmethod
+	@asyncio.coroutine
+	def count(cls,where=None,args=None,estimate=False):
+		'count rows by where, cached.'
+		if estimate and not where:
+			key=(cls.__table__,'__estimate__',())
+			n=_count_cache.get(key)
+			if n is None:
+				rs=yield from select('select `table_rows` _num_ from `information_schema`.`tables` where `table_schema`=database() and `table_name`=?',[cls.__table__],1)
+				n=int(rs[0]['_num_'] or 0) if rs else 0
+				_count_cache.set(key,n)
+			if n>=_ESTIMATE_MIN:
+				return n
+		key=(cls.__table__,where or None,tuple(args or ()))
+		n=_count_cache.get(key)
+		if n is None:
+			n=yield from cls.findNumber('count(`%s`)'%cls.__primary_key__,where,args)
+			_count_cache.set(key,n)
+		return n
+
 	#根据主键查找pk的值，取第一条
 	@classmethod
 	@asyncio.coroutine
-	def find(cls,pk):
+	def find(cls,pk,coalesce=None):
 		'find object by primary key.'
-		rs=yield from select('%s where `%s`=?'%(cls.__select__,cls.__primary_key__),[pk],1)
-		if len(rs)==0:
-			return None
-		return cls(**rs[0])
+		imap=_identity_map()
+		if imap is not None:
+			hit,row=imap.get(cls,pk)
+			if hit:
+				return None if row is None else cls(**row)
+		rs=yield from select(cls.__find__,[pk],1,cls._coalesce(coalesce))
+		obj=cls(**rs[0]) if rs else None
+		if imap is not None:
+			imap.put(cls,pk,obj)
+		return obj
+
+	#按主键批量查找，每batch_size个主键一条where pk in (...)查询
+	#返回(对象列表,没找到的主键列表)，对象按ids的顺序排列，重复的主键只返回一个对象
+	#和findAll一样默认不查询lazy列，columns指定要查询的列(见selectColumns)
+	#当前请求的identity map里已经有的对象不再查询，只查了部分列的对象不放进identity map
+	@classmethod
+	@asyncio.coroutine
+	def findMany(cls,ids,batch_size=500,coalesce=None,columns=None):
+		'find objects by a list of primary keys.'
+		ids=list(OrderedDict.fromkeys(ids))
+		if columns is not None:
+			columns=tuple(columns)
+		full=len(cls.selectColumns(columns))==len(cls.__mappings__)
+		rows={}
+		imap=_identity_map()
+		misses=[]
+		for pk in ids:
+			hit,row=imap.get(cls,pk) if imap is not None else (False,None)
+			if hit:
+				if row is not None:
+					rows[pk]=row
+			else:
+				misses.append(pk)
+		for i in range(0,len(misses),batch_size):
+			batch=misses[i:i+batch_size]
+			#in (...)的参数个数补齐到2的幂(最多batch_size)，用最后一个主键填充，这样每个Model只有几种语句，不会占满语句缓存
+			n=_padded_size(len(batch),batch_size)
+			key=(cls,'many',n,columns)
+			sql=_statement_cache.get(key)
+			if sql is None:
+				sql=cls._buildSelect('`%s` in (%s)'%(cls.__primary_key__,create_args_string(n)),None,False,0,columns)
+				_statement_cache.set(key,sql)
+			rs=yield from select(sql,batch+batch[-1:]*(n-len(batch)),coalesce=cls._coalesce(coalesce))
+			for r in rs:
+				rows[r[cls.__primary_key__]]=r
+			if imap is not None:
+				for pk in batch:
+					if full or pk not in rows:
+						imap.put(cls,pk,rows.get(pk))
+		return [cls(**rows[pk]) for pk in ids if pk in rows],[pk for pk in ids if pk not in rows]
 
 	#根据当前类的属性，往相关table里插入一条数据
 	@asyncio.coroutine
 	def save(self):
 		args=list(map(self.getValueOrDefault,self.__fields__))
 		args.append(self.getValueOrDefault(self.__primary_key__))
-		rows=yield from execute(self.__insert__,args)
-		if rows!=1:
+		return (yield from _write(self.__insert__,args,self._saved))
+
+	#insert执行后调用，rows为None表示不知道插入了几行
+	def _saved(self,rows):
+		if rows is not None and rows!=1:
 			logging.warn('failed to insert record:affected rows:%s'%rows)
+		_count_changed(self.__table__,rows)
+		_notify('save',self)
 
-	#更新条目数据
+	#插入，主键或唯一索引冲突时更新已有的记录，一条语句完成，不需要先find再save/update
+	#fields是冲突时要更新的列，为空时更新所有列(比如不想改created_at时把它排除掉)
+	#返回'inserted'、'updated'或'unchanged'(记录已存在且各列的值都一样)
+	@asyncio.coroutine
+	def upsert(self,*fields):
+		args=list(map(self.getValueOrDefault,self.__fields__))
+		args.append(self.getValueOrDefault(self.__primary_key__))
+		if fields:
+			key=(type(self),'upsert',fields)
+			sql=_statement_cache.get(key)
+			if sql is None:
+				for f in fields:
+					if f not in self.__fields__:
+						raise ValueError('Invalid field:%s'%f)
+				sql=Statement('%s on duplicate key update %s'%(self.__insert__,', '.join(map(lambda f:'`%s`=values(`%s`)'%(f,f),fields))))
+				_statement_cache.set(key,sql)
+		else:
+			sql=self.__upsert__
+		rows=yield from _write(sql,args,self._upserted,queue=False)
+		return _UPSERT_RESULTS.get(rows)
+
+	#mysql的on duplicate key update：插入返回1，更新返回2，没有变化返回0
+	def _upserted(self,rows):
+		if rows==1:
+			self._saved(rows)
+		elif rows!=0:
+			_count_changed(self.__table__,None if rows is None else 0)
+			_notify('update',self)
+			#更新了已有的记录，没有更新的列(比如created_at)数据库里还是原来的值，对象里的不能用
+			imap=identity_map.get()
+			if imap is not None:
+				imap.discard(type(self),self.getValue(self.__primary_key__))
+
+	#插入，主键或唯一索引冲突时什么都不做，返回是否插入了
+	#用on duplicate key update `主键`=`主键`而不是insert ignore，其他错误(数据太长等)照样抛出
+	@asyncio.coroutine
+	def insertIgnore(self):
+		args=list(map(self.getValueOrDefault,self.__fields__))
+		args.append(self.getValueOrDefault(self.__primary_key__))
+		rows=yield from _write(self.__insert_ignore__,args,self._inserted,queue=False)
+		return rows==1
+
+	def _inserted(self,rows):
+		if rows:
+			self._saved(rows)
+
+	#批量插入，一个事务里用executemany分批插入，返回每一批插入的行数
+	@classmethod
+	@asyncio.coroutine
+	def saveMany(cls,objs,batch_size=500):
+		'insert objects in batches inside one transaction.'
+		objs=list(objs)
+		seq_args=[]
+		for obj in objs:
+			args=list(map(obj.getValueOrDefault,cls.__fields__))
+			args.append(obj.getValueOrDefault(cls.__primary_key__))
+			seq_args.append(args)
+		if not seq_args:
+			return []
+		#在事务里时和save一样放进队列，提交时合并成executemany
+		if _transaction.get() is not None:
+			for obj,args in zip(objs,seq_args):
+				yield from _write(cls.__insert__,args,obj._saved)
+			return None
+		counts=yield from executemany(cls.__insert__,seq_args,batch_size)
+		if sum(counts)!=len(seq_args):
+			logging.warn('failed to insert %s records:affected rows:%s'%(len(seq_args),sum(counts)))
+		_count_changed(cls.__table__,sum(counts))
+		for obj in objs:
+			_notify('save',obj)
+		return counts
+
+	#更新条目数据，只加载了部分列的对象(findAll的columns参数、lazy列)只更新已加载的列
 	@asyncio.coroutine
 	def update(self):
-		args=list(map(self.getValue,self.__fields__))
+		values=self.loadedValues()
+		fields=[f for f in self.__fields__ if f in values]
+		if len(fields)==len(self.__fields__):
+			sql=self.__update__
+		elif fields:
+			key=(type(self),'update',tuple(fields))
+			sql=_statement_cache.get(key)
+			if sql is None:
+				sql=Statement('update `%s` set %s where `%s`=?'%(self.__table__,', '.join(map(lambda f:'`%s`=?'%(self.__mappings__.get(f).name or f),fields)),self.__primary_key__))
+				_statement_cache.set(key,sql)
+		else:
+			logging.warn('nothing to update')
+			return
+		args=[values[f] for f in fields]
 		args.append(self.getValue(self.__primary_key__))
-		rows=yield from execute(self.__update__,args)
-		if rows!=1:
-			logging.warn('failed to update by primary key:affected rows:%s'%rows)
+		def done(rows):
+			if rows is not None and rows!=1:
+				logging.warn('failed to update by primary key:affected rows:%s'%rows)
+			_count_changed(self.__table__,0)
+			_notify('update',self)
+		return (yield from _write(sql,args,done))
 
 	#根据主键的值删除条目
 	@asyncio.coroutine
 	def remove(self):
 		args=[self.getValue(self.__primary_key__)]
-		rows=yield from execute(self.__delete__,args)
-		if rows!=1:
-			logging.warn('failed to remove by primary key:affected rows:%s'%rows)
+		def done(rows):
+			if rows is not None and rows!=1:
+				logging.warn('failed to remove by primary key:affected rows:%s'%rows)
+			_count_changed(self.__table__,None if rows is None else -rows)
+			_notify('remove',self)
+		return (yield from _write(self.__delete__,args,done))
+
+	#按条件删除，只执行一条delete语句，返回删除的行数(在事务里时放进队列，返回None)
+	#当前请求的identity map里这个表的记录全部丢掉
+	#这个Model注册了监听器时，先查出要删除的对象，删除后(在事务里是提交后)对每个对象调用监听器
+	@classmethod
+	@asyncio.coroutine
+	def removeAll(cls,where,args=None):
+		'delete rows by where clause.'
+		key=(cls,'delete',where)
+		sql=_statement_cache.get(key)
+		if sql is None:
+			sql=Statement('delete from `%s` where %s'%(cls.__table__,where))
+			_statement_cache.set(key,sql)
+		objs=[]
+		if _listeners.get(cls):
+			objs=yield from cls.findAll(where,args)
+		def done(rows):
+			_count_changed(cls.__table__,None if rows is None else -rows)
+			imap=identity_map.get()
+			if imap is not None:
+				imap.drop(cls)
+			for obj in objs:
+				_notify('remove',obj)
+		return (yield from _write(sql,list(args or []),done))
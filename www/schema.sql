@@ -29,6 +29,9 @@ create table blogs (
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext not null,
+    `content_hash` varchar(40) not null default '',
+    `renderer_version` bigint not null default 0,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
@@ -43,5 +46,6 @@ create table comments (
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`,`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
\ No newline at end of file
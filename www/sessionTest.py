@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+cookie2user的session缓存不能泄露密码的hash：
+
+    python3 sessionTest.py
+'''
+
+import asyncio,hashlib,unittest
+from unittest import mock
+
+import handlers,jsonenc
+from models import User
+
+class TestSessionCache(unittest.TestCase):
+    """docstring for TestSessionCache"""
+    def setUp(self):
+        self.passwd=hashlib.sha1(b'test@example.com:123456').hexdigest()
+        self.user=User(id='0001',name='Test',email='test@example.com',passwd=self.passwd,image='about:blank',admin=False)
+        handlers._SESSION_CACHE.clear()
+        self.loop=asyncio.new_event_loop()
+
+    def tearDown(self):
+        handlers._SESSION_CACHE.clear()
+        self.loop.close()
+
+    def cookie2user(self,cookie_str):
+        @asyncio.coroutine
+        def find(pk,coalesce=None):
+            return User(**self.user) if pk==self.user.id else None
+        with mock.patch.object(User,'find',find):
+            return self.loop.run_until_complete(handlers.cookie2user(cookie_str))
+
+    def assertHidden(self,user):
+        self.assertEqual(user.passwd,'******')
+        self.assertEqual(user['passwd'],'******')
+        self.assertNotIn(self.passwd.encode('utf-8'),jsonenc.dumps(user))
+
+    def test_cache_hit_hides_passwd(self):
+        cookie_str=handlers.user2cookie(self.user,86400)
+        #第一次查数据库并放进缓存，第二次命中缓存
+        self.assertHidden(self.cookie2user(cookie_str))
+        hits=handlers.session_cache_stats()['hits']
+        user=self.cookie2user(cookie_str)
+        self.assertEqual(handlers.session_cache_stats()['hits'],hits+1)
+        self.assertHidden(user)
+        self.assertEqual(user.id,self.user.id)
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Wby'
+
+'''
+Multi-process master for app.py.
+'''
+
+import logging; logging.basicConfig(level=logging.INFO)
+import os, sys, time, signal, socket, select, subprocess
+
+#创建监听socket，所有worker继承同一个socket，由内核在worker之间分配连接
+def create_listen_socket(host,port,backlog=128):
+    sock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    sock.bind((host,port))
+    sock.listen(backlog)
+    #子进程要继承这个fd
+    sock.set_inheritable(True)
+    return sock
+
+#master进程：启动n个worker，worker异常退出时重新启动，收到SIGTERM/SIGINT时通知所有worker退出
+#worker通过执行script --fd <fd>启动(fork+exec)，每个worker有自己的事件循环和数据库连接池
+#收到SIGHUP时平滑重启：用新代码启动一组新worker，都预热好之后再让旧worker处理完请求退出
+class Master(object):
+    """docstring for Master"""
+    #worker启动后不到这么多秒就退出，认为是启动失败，下次重启前等待一下，避免不停地重启
+    MIN_UPTIME=1.0
+    RESTART_DELAY=1.0
+    #平滑重启时等待新worker预热完成的时间
+    READY_TIMEOUT=60.0
+
+    def __init__(self, sock,workers,script,stop_timeout=60.0):
+        self.sock=sock
+        self.workers=workers
+        #用没有解析过软链接的路径启动worker，这样部署切换www软链接后新启动的worker就是新代码
+        self.script=script
+        self.stop_timeout=stop_timeout
+        #pid->(Popen,启动时间)
+        self.children={}
+        #正在退出的worker，pid->(Popen,最迟退出时间)
+        self.retiring={}
+        self.stopping=False
+        self.reloading=False
+
+    #启动一个worker
+    #ready_fd:管道的写端，worker预热完成后往里面写一个字节
+    def spawn(self,ready_fd=None):
+        fd=self.sock.fileno()
+        cmd=[sys.executable,self.script,'--fd',str(fd),'--workers',str(self.workers)]
+        fds=[fd]
+        if ready_fd is not None:
+            cmd.extend(['--ready-fd',str(ready_fd)])
+            fds.append(ready_fd)
+        p=subprocess.Popen(cmd,pass_fds=fds,cwd=os.path.dirname(self.script))
+        self.children[p.pid]=(p,time.time())
+        logging.info('[master] started worker %s'%p.pid)
+        return p
+
+    def _on_stop(self,signum,frame):
+        logging.info('[master] got signal %s, stopping workers...'%signum)
+        self.stopping=True
+
+    def _on_reload(self,signum,frame):
+        logging.info('[master] got SIGHUP, reloading workers...')
+        self.reloading=True
+
+    def run(self):
+        signal.signal(signal.SIGTERM,self._on_stop)
+        signal.signal(signal.SIGINT,self._on_stop)
+        signal.signal(signal.SIGHUP,self._on_reload)
+        logging.info('[master] %s started, workers:%s'%(os.getpid(),self.workers))
+        for i in range(self.workers):
+            self.spawn()
+        while not self.stopping:
+            if self.reloading:
+                self.reloading=False
+                self.reload()
+            self.reap()
+            time.sleep(0.5)
+        self.stop_all()
+        logging.info('[master] exit')
+
+    #检查退出的worker，不是master要求退出的就重新启动
+    def reap(self):
+        for pid,(p,deadline) in list(self.retiring.items()):
+            if p.poll() is not None:
+                del self.retiring[pid]
+            elif time.time()>deadline:
+                logging.warning('[master] worker %s did not exit in time, killing'%pid)
+                p.kill()
+                p.wait()
+                del self.retiring[pid]
+        for pid,(p,started) in list(self.children.items()):
+            code=p.poll()
+            if code is None:
+                continue
+            del self.children[pid]
+            logging.warning('[master] worker %s exited with code %s, restarting'%(pid,code))
+            if time.time()-started<self.MIN_UPTIME:
+                time.sleep(self.RESTART_DELAY)
+            self.spawn()
+
+    #平滑重启：启动新的一组worker，等它们都打开连接池、编译好模板后，再让旧worker处理完请求退出
+    #新worker有一个没能就绪，就放弃这次重启，停掉新worker，旧worker继续服务
+    def reload(self):
+        old=list(self.children)
+        r,w=os.pipe()
+        try:
+            new=[self.spawn(w).pid for i in range(self.workers)]
+        finally:
+            os.close(w)
+        ready=0
+        deadline=time.time()+self.READY_TIMEOUT
+        try:
+            while ready<len(new) and not self.stopping:
+                timeout=deadline-time.time()
+                if timeout<=0:
+                    break
+                rl,wl,xl=select.select([r],[],[],min(timeout,0.5))
+                if rl:
+                    data=os.read(r,len(new))
+                    #所有worker都关掉写端了
+                    if not data:
+                        break
+                    ready+=len(data)
+                elif any(pid not in self.children or self.children[pid][0].poll() is not None for pid in new):
+                    break
+        finally:
+            os.close(r)
+        if ready<len(new):
+            logging.error('[master] only %s of %s new workers became ready, keep old workers'%(ready,len(new)))
+            self.retire([pid for pid in new if pid in self.children])
+            return
+        logging.info('[master] new workers ready:%s, stopping old workers:%s'%(new,old))
+        self.retire([pid for pid in old if pid in self.children])
+
+    #通知worker退出(SIGTERM)，worker会处理完正在处理的请求再退出，超时的由reap直接kill
+    #退出中的worker不再由master重启
+    def retire(self,pids):
+        deadline=time.time()+self.stop_timeout
+        for pid in pids:
+            p,started=self.children.pop(pid)
+            if p.poll() is None:
+                p.send_signal(signal.SIGTERM)
+            self.retiring[pid]=(p,deadline)
+
+    #停止所有worker，等它们都退出
+    def stop_all(self):
+        self.retire(list(self.children))
+        while self.retiring:
+            self.reap()
+            time.sleep(0.1)